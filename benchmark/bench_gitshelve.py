@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# bench_gitshelve.py
+#
+# Measures how gitshelve's core operations scale.  Each configuration gets a
+# fresh repository holding a synthetic branch of KEYS values, written
+# directly with git fast-import so that building a million-key branch takes
+# seconds rather than hours.  Against that branch it times:
+#
+#   open      gitshelve.open(), i.e. read_repository()
+#   get       reading randomly chosen values from a freshly opened shelf
+#   commit    changing values with __setitem__ and committing them
+#   put       storing new values with put()
+#   iterate   walking every key
+#   memory    the Python heap allocated while opening the shelf
+#
+# Examples:
+#
+#   python benchmark/bench_gitshelve.py --keys 1000 10000 100000
+#   python benchmark/bench_gitshelve.py --layout deep --value-size 4096 \
+#       --option backend=python --option compact=True --output new.json
+#   python benchmark/bench_gitshelve.py --compare old.json new.json
+#
+# Results are written as JSON, one record per configuration, so that runs
+# against different versions of gitshelve can be compared.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from subprocess import Popen, PIPE
+
+try:
+    import tracemalloc
+except ImportError:             # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import gitshelve
+
+BRANCH = 'bench'
+LAYOUTS = ('flat', 'deep')
+
+
+def key_path(layout, i):
+    """Return the path of the I'th key.  A flat layout keeps every key in
+    one tree; a deep one fans them out three levels, like a hashed store."""
+    name = '%08x' % (i * 2654435761 % (1 << 32))
+    if layout == 'flat':
+        return 'k%s' % name
+    return '%s/%s/%s/%s' % (name[:2], name[2:4], name[4:6], name)
+
+
+def value_of(i, size, generation=0):
+    text = 'value %d.%d ' % (i, generation)
+    return (text * (size // len(text) + 1))[:size]
+
+
+def populate(repository, layout, keys, value_size):
+    """Write a branch of KEYS values in a single fast-import run."""
+    proc = Popen(['git', 'fast-import', '--quiet', '--done'], stdin=PIPE,
+                 env=gitshelve.git_environ(repository))
+    write = proc.stdin.write
+    write(b'commit refs/heads/' + BRANCH.encode() + b'\n'
+          b'committer bench <bench@example> 0 +0000\n'
+          b'data 8\npopulate\n')
+    for i in range(keys):
+        data = value_of(i, value_size).encode()
+        write(('M 100644 inline %s\ndata %d\n' %
+               (key_path(layout, i), len(data))).encode())
+        write(data + b'\n')
+    write(b'\ndone\n')
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def latencies(samples):
+    """Return the mean, median and 99th percentile of SAMPLES, or None if
+    there are none."""
+    if not samples:
+        return None
+    return {'mean': sum(samples) / len(samples),
+            'p50': percentile(samples, 0.5),
+            'p99': percentile(samples, 0.99)}
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def heap_used(func):
+    """Return the peak Python heap allocated while calling FUNC, or None
+    where tracemalloc is not available."""
+    if tracemalloc is None:
+        return None, func()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def run(repository, layout, keys, value_size, options, args):
+    rng = random.Random(args.seed)
+    result = {'layout': layout, 'keys': keys, 'value_size': value_size,
+              'options': options}
+
+    result['populate'], _ = timed(populate, repository, layout, keys,
+                                  value_size)
+
+    def open_shelf():
+        return gitshelve.open(BRANCH, repository, **options)
+
+    result['open'], shelf = timed(open_shelf)
+    shelf.close()
+
+    result['memory'], shelf = heap_used(open_shelf)
+
+    samples = []
+    for i in rng.sample(range(keys), min(args.gets, keys)):
+        path = key_path(layout, i)
+        elapsed, _ = timed(shelf.__getitem__, path)
+        samples.append(elapsed)
+    result['get'] = latencies(samples)
+
+    result['iterate'], count = timed(lambda: sum(1 for _ in shelf))
+    assert count == keys, (count, keys)
+
+    changes = rng.sample(range(keys), min(args.sets, keys))
+    start = time.time()
+    for i in changes:
+        shelf[key_path(layout, i)] = value_of(i, value_size, 1)
+    result['set'] = time.time() - start
+    result['commit'], _ = timed(shelf.commit, 'bench')
+    result['set_commit_per_sec'] = \
+        len(changes) / (result['set'] + result['commit'])
+
+    start = time.time()
+    for i in range(args.puts):
+        shelf.put(value_of(keys + i, value_size))
+    result['put'] = time.time() - start
+    result['put_per_sec'] = args.puts / result['put'] if args.puts else None
+    shelf.close()
+    return result
+
+
+def parse_option(text):
+    """Turn NAME=VALUE into a gitshelve.open() keyword argument."""
+    name, _, value = text.partition('=')
+    try:
+        value = json.loads(value.lower() if value in ('True', 'False')
+                           else value)
+    except ValueError:
+        pass
+    return name, value
+
+
+def compare(old_file, new_file):
+    """Print the ratio of every timing in NEW_FILE to the same layout, size
+    and value size in OLD_FILE; above 1.0 means slower."""
+    def load(filename):
+        with open(filename) as fd:
+            report = json.load(fd)
+        return dict(((r['layout'], r['keys'], r['value_size']), r)
+                    for r in report['results'])
+    old, new = load(old_file), load(new_file)
+    for config in sorted(set(old) & set(new)):
+        print('%s %d keys %d bytes %s -> %s' %
+              (config + (json.dumps(old[config]['options'], sort_keys=True),
+                         json.dumps(new[config]['options'], sort_keys=True))))
+        for metric in ('open', 'iterate', 'set', 'commit', 'put', 'memory'):
+            before, after = old[config].get(metric), new[config].get(metric)
+            if before and after is not None:
+                print('  %-8s %12.4f -> %12.4f  x%.2f' %
+                      (metric, before, after, after / before))
+        before, after = old[config].get('get'), new[config].get('get')
+        if before and after and before['p50']:
+            print('  %-8s %12.6f -> %12.6f  x%.2f' %
+                  ('get p50', before['p50'], after['p50'],
+                   after['p50'] / before['p50']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time gitshelve operations on synthetic branches.')
+    parser.add_argument('--keys', type=int, nargs='+', default=[1000, 10000],
+                        help='shelf sizes to measure')
+    parser.add_argument('--layout', choices=LAYOUTS + ('all',),
+                        default='all')
+    parser.add_argument('--value-size', type=int, nargs='+',
+                        default=[32, 4096], help='bytes per value')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='keyword argument for gitshelve.open(), '
+                             'e.g. backend=python')
+    parser.add_argument('--gets', type=int, default=1000,
+                        help='random values read per configuration')
+    parser.add_argument('--sets', type=int, default=1000,
+                        help='values changed before the timed commit')
+    parser.add_argument('--puts', type=int, default=1000,
+                        help='values stored with put()')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    for name in ('AUTHOR', 'COMMITTER'):
+        os.environ.setdefault('GIT_%s_NAME' % name, 'bench')
+        os.environ.setdefault('GIT_%s_EMAIL' % name, 'bench@example')
+
+    options = dict(parse_option(text) for text in args.option)
+    layouts = LAYOUTS if args.layout == 'all' else (args.layout,)
+    report = {'gitshelve': gitshelve.GITSHELVE_VERSION,
+              'git': gitshelve.git('version'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': []}
+    for layout in layouts:
+        for keys in args.keys:
+            for value_size in args.value_size:
+                repository = tempfile.mkdtemp(prefix='gitshelve-bench-')
+                try:
+                    Popen(['git', 'init', '--quiet', '--bare',
+                           repository]).wait()
+                    result = run(repository, layout, keys, value_size,
+                                 options, args)
+                finally:
+                    shutil.rmtree(repository)
+                report['results'].append(result)
+                print('%-4s %8d keys %6d bytes: open %.3fs, get p50 %.6fs, '
+                      'commit %.3fs, put %.1f/s' %
+                      (layout, keys, value_size, result['open'],
+                       result['get'] and result['get']['p50'] or 0,
+                       result['commit'],
+                       result['put_per_sec'] or 0), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,17 +32,112 @@
 
 GITSHELVE_VERSION="0.1.1"
 
+import binascii
+import bisect
+import glob
+import hashlib
+import io
+import mmap
 import os
 from pipes import quote
-import re
+import random
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
 from subprocess import Popen, PIPE
 
+try:
+    from collections import OrderedDict
+except ImportError:             # Python 2.6
+    class OrderedDict(dict):
+        """As much of OrderedDict as the caches below use: setting, getting
+        and popping keys, and popitem() from either end.  Each key stored
+        is queued with a stamp; popitem() skips the entries whose keys have
+        since been removed, and the queue is rebuilt once they outnumber
+        the live ones."""
+        def __init__(self):
+            dict.__init__(self)
+            self.order = deque()
+            self.stamps = {}
+            self.stamp = 0
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                self.stamp += 1
+                self.stamps[key] = self.stamp
+                self.order.append((self.stamp, key))
+                if len(self.order) > 2 * len(self.stamps) + 16:
+                    self.order = deque(sorted((stamp, key) for key, stamp
+                                              in self.stamps.items()))
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            del self.stamps[key]
+
+        def pop(self, key, *default):
+            if key in self:
+                del self.stamps[key]
+            return dict.pop(self, key, *default)
+
+        def popitem(self, last=True):
+            while self.order:
+                if last:
+                    stamp, key = self.order.pop()
+                else:
+                    stamp, key = self.order.popleft()
+                if self.stamps.get(key) == stamp:
+                    del self.stamps[key]
+                    return key, dict.pop(self, key)
+            raise KeyError('dictionary is empty')
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:             # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    import fcntl
+except ImportError:             # Windows
+    fcntl = None
+
 
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
+try:
+    from copyreg import __newobj__
+except ImportError:             # Python 2
+    from copy_reg import __newobj__
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # Python 2's builtin only takes byte strings, and the paths read from
+    # Git are unicode; those are left as they are.
+    def intern(text, intern=intern):
+        if isinstance(text, str):
+            return intern(text)
+        return text
+
 
 ######################################################################
 
@@ -79,13 +174,119 @@ class GitError(Exception):
         return errorMsg
 
 
+class GitConflict(GitError):
+    """Raised when a commit cannot be replayed onto a branch that moved
+    under it, because the other writer changed some of the same keys.
+    Their paths are listed in 'paths'."""
+    def __init__(self, cmd, args, kwargs, paths, stderr=None, returncode=0):
+        GitError.__init__(self, cmd, args, kwargs, stderr, returncode)
+        self.paths = paths
+
+    def __unicode__(self):
+        return "%s (conflicting keys: %s)" % (GitError.__unicode__(self),
+                                               ', '.join(self.paths))
+
+
+class gitstats(object):
+    """Counts and times the Git commands run on behalf of gitshelve.  For
+    each subcommand it keeps the number of calls, the processes spawned for
+    them, failures, bytes written to and read from Git, and the total time
+    taken; percentiles are taken over the last 'window' calls.
+
+    Functions added with add_hook(func, threshold) are called as
+    func(cmd, args, elapsed) after every command taking at least threshold
+    seconds.  The long-lived cat-file and fast-import processes are recorded
+    once per batch of objects read, and once per import, respectively."""
+    window = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.commands = {}
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.commands = {}
+        finally:
+            self.lock.release()
+
+    def add_hook(self, func, threshold=0.0):
+        self.hooks.append((threshold, func))
+
+    def remove_hook(self, func):
+        self.hooks = [hook for hook in self.hooks if hook[1] is not func]
+
+    def record(self, cmd, args, elapsed, bytes_in=0, bytes_out=0,
+               failed=False, spawns=1):
+        self.lock.acquire()
+        try:
+            entry = self.commands.get(cmd)
+            if entry is None:
+                entry = self.commands[cmd] = {
+                    'count': 0, 'spawns': 0, 'failures': 0, 'bytes_in': 0,
+                    'bytes_out': 0, 'time': 0.0,
+                    'times': deque(maxlen=self.window)}
+            entry['count'] += 1
+            entry['spawns'] += spawns
+            entry['failures'] += bool(failed)
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+            entry['time'] += elapsed
+            entry['times'].append(elapsed)
+        finally:
+            self.lock.release()
+        for threshold, func in list(self.hooks):
+            if elapsed >= threshold:
+                func(cmd, args, elapsed)
+
+    def spawns(self):
+        """Return the number of Git processes started so far."""
+        return sum(entry['spawns'] for entry in list(self.commands.values()))
+
+    def summary(self):
+        """Return a dict mapping each subcommand to its counters."""
+        self.lock.acquire()
+        try:
+            commands = [(cmd, dict(entry), sorted(entry['times']))
+                        for cmd, entry in self.commands.items()]
+        finally:
+            self.lock.release()
+        result = {}
+        for cmd, entry, times in commands:
+            del entry['times']
+            entry['mean'] = entry['time'] / entry['count']
+            for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99)):
+                entry[name] = times[min(len(times) - 1,
+                                        int(len(times) * fraction))]
+            entry['max'] = times[-1]
+            result[cmd] = entry
+        return result
+
+
+# Every Git command run by this module is recorded here, as well as in the
+# gitstats of the shelf it was run for.
+default_stats = gitstats()
+
+
+def record_git(stats, cmd, args, elapsed, **counts):
+    default_stats.record(cmd, args, elapsed, **counts)
+    if stats is not None and stats is not default_stats:
+        stats.record(cmd, args, elapsed, **counts)
+
+
 def __set_repo_environ(environ, repository):
     if repository is not None:
         git_dir = environ['GIT_DIR'] = repository
         if not os.path.isdir(git_dir):
+            start = time.time()
             proc = Popen(('git', 'init'), env=environ,
                          stdout=PIPE, stderr=PIPE)
-            if proc.wait() != 0:
+            returncode = proc.wait()
+            record_git(None, 'init', (), time.time() - start,
+                       failed=returncode != 0)
+            if returncode != 0:
                 raise GitError('init', [], {}, proc.stderr.read())
 
 
@@ -96,34 +297,82 @@ def __set_worktree_environ(environ, worktree):
             os.makedirs(worktree)
 
 
+def git_environ(repository=None, worktree=None):
+    environ = os.environ.copy()
+    __set_repo_environ(environ, repository)
+    __set_worktree_environ(environ, worktree)
+    return environ
+
+
+def to_unicode(data):
+    try:
+        return str(data, 'utf-8')
+    except TypeError:
+        return unicode(data, 'utf-8')
+
+
+def to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def object_header(kind, data):
+    return ('%s %d\0' % (kind, len(data))).encode('ascii')
+
+
+def hash_object(kind, data, algorithm='sha1'):
+    """Return the name Git gives an object of type KIND holding DATA, in a
+    repository whose objects are named with the hash ALGORITHM."""
+    sha = hashlib.new(algorithm, object_header(kind, data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def read_object_format(git_dir):
+    """Return the hash algorithm naming the objects of the repository in
+    GIT_DIR, as set by its extensions.objectFormat: 'sha1' by default."""
+    config = os.path.join(git_dir, 'config')
+    if not os.path.isfile(config):
+        return 'sha1'
+    f = io.open(config, encoding='utf-8', errors='replace')
+    try:
+        for line in f:
+            line = line.strip().lower().replace(' ', '')
+            if line.startswith('objectformat='):
+                return line[len('objectformat='):]
+    finally:
+        f.close()
+    return 'sha1'
+
+
 def git(cmd, *args, **kwargs):
     stdin_mode = None
     if 'input' in kwargs:
         stdin_mode = PIPE
 
-    environ = os.environ.copy()
-    __set_repo_environ(environ, kwargs.get('repository'))
-    __set_worktree_environ(environ, kwargs.get('worktree'))
+    environ = git_environ(kwargs.get('repository'), kwargs.get('worktree'))
 
+    start = time.time()
     proc = Popen(('git', cmd) + args, env=environ,
                  stdin=stdin_mode,
                  stdout=PIPE,
                  stderr=PIPE)
 
     input_str = kwargs.get('input', '')
-    if isinstance(input_str, str):
-        input_str = input_str.encode("utf-8")
+    if input_str is not None:
+        input_str = to_bytes(input_str)
     out, err = proc.communicate(input_str)
 
     returncode = proc.returncode
+    record_git(kwargs.get('stats'), cmd, args, time.time() - start,
+               bytes_in=len(input_str or b''), bytes_out=len(out),
+               failed=returncode != 0)
     ignore_errors = kwargs.get('ignore_errors', False)
     if returncode != 0 and not ignore_errors:
         raise GitError(cmd, args, kwargs, err, returncode)
 
-    try:
-        retval = str(out, 'utf-8')
-    except TypeError:
-        retval = unicode(out, 'utf-8')
+    retval = to_unicode(out)
 
     if 'keep_newline' not in kwargs:
         retval = retval[:-1]
@@ -131,9 +380,1086 @@ def git(cmd, *args, **kwargs):
     return retval
 
 
-class gitbook:
+def git_stream(cmd, *args, **kwargs):
+    """Like git(), but yields the command's output in chunks of at most
+    'chunk_size' bytes as it arrives, rather than collecting all of it in
+    memory first."""
+    chunk_size = kwargs.get('chunk_size', 65536)
+    environ = git_environ(kwargs.get('repository'), kwargs.get('worktree'))
+
+    start = time.time()
+    size = 0
+    proc = Popen(('git', cmd) + args, env=environ, stdout=PIPE, stderr=PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            yield chunk
+    finally:
+        proc.stdout.close()
+        err = proc.stderr.read()
+        proc.stderr.close()
+        returncode = proc.wait()
+        # the time includes whatever the caller did with each chunk
+        record_git(kwargs.get('stats'), cmd, args, time.time() - start,
+                   bytes_out=size, failed=returncode != 0)
+
+    if returncode != 0 and not kwargs.get('ignore_errors', False):
+        raise GitError(cmd, args, kwargs, err, returncode)
+
+
+class gitreader(object):
+    """Reads objects through a single long-lived 'git cat-file --batch'
+    process, rather than forking Git once for every object.  The process is
+    started on first use, restarted if it dies, and stopped by close()."""
+    def __init__(self, repository=None, stats=None):
+        self.repository = repository
+        self.stats = stats
+        self.proc = None
+        self.spawns = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.spawns += 1
+        self.proc = Popen(('git', 'cat-file', '--batch'),
+                          env=git_environ(self.repository),
+                          stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    def ensure_started(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.close()
+            self.start()
+
+    def response(self):
+        """Read one reply from the process, returning (type, data), or None
+        if the object asked for is missing."""
+        header = self.proc.stdout.readline()
+        if not header:
+            raise IOError("git cat-file --batch exited")
+        fields = header.split()
+        if len(fields) != 3:
+            return None
+        size = int(fields[2])
+        data = self.proc.stdout.read(size + 1)
+        if len(data) != size + 1:
+            raise IOError("git cat-file --batch exited")
+        return to_unicode(fields[1]), data[:-1]
+
+    def request(self, name):
+        self.ensure_started()
+        self.proc.stdin.write(name.encode('utf-8') + b'\n')
+        self.proc.stdin.flush()
+        return self.response()
+
+    def request_many(self, names):
+        self.ensure_started()
+        proc = self.proc
+
+        # Requests are written from a separate thread, so that Git never
+        # blocks on a full stdout pipe while we are still feeding it stdin.
+        def feed():
+            try:
+                for name in names:
+                    proc.stdin.write(name.encode('utf-8') + b'\n')
+                proc.stdin.flush()
+            except (IOError, OSError, ValueError):
+                pass  # the process died; response() will notice
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+        try:
+            return [self.response() for name in names]
+        finally:
+            writer.join()
+
+    def retry(self, func, *args):
+        self.lock.acquire()
+        try:
+            # A dead or wedged process is replaced once; a second failure in
+            # a row means something is wrong with the repository itself.
+            try:
+                return func(*args)
+            except (IOError, OSError, ValueError):
+                self.close()
+            try:
+                return func(*args)
+            except (IOError, OSError, ValueError):
+                self.close()
+                raise GitError('cat-file', ['--batch'], {},
+                               "reader died while reading objects")
+        finally:
+            self.lock.release()
+
+    def timed(self, func, names):
+        """Call FUNC(NAMES) through retry(), recording it in the stats."""
+        start, spawns = time.time(), self.spawns
+        results = None
+        try:
+            results = self.retry(func, names)
+            return results
+        finally:
+            if isinstance(names, string_types):
+                names, results = [names], [results]
+            failed = results is None or None in results
+            record_git(self.stats, 'cat-file', ('--batch',),
+                       time.time() - start,
+                       bytes_in=sum(len(name) + 1 for name in names),
+                       bytes_out=sum(len(result[1]) for result
+                                     in (results or []) if result),
+                       failed=failed, spawns=self.spawns - spawns)
+
+    def read(self, name):
+        """Return (type, data) for the object called NAME."""
+        result = self.timed(self.request, name)
+        if result is None:
+            raise GitError('cat-file', ['--batch'], {}, "%s missing" % name)
+        return result
+
+    def read_many(self, names):
+        """Return a dict mapping each of NAMES to its (type, data), reading
+        them all in a single pipelined request."""
+        names = list(set(names))
+        results = self.timed(self.request_many, names)
+        objects = {}
+        for name, result in zip(names, results):
+            if result is None:
+                raise GitError('cat-file', ['--batch'], {},
+                               "%s missing" % name)
+            objects[name] = result
+        return objects
+
+
+def fast_import_path(path):
+    """Quote PATH for use in a fast-import command, if it needs it."""
+    if path.startswith('"') or '\n' in path:
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"') \
+                            .replace('\n', '\\n')
+    return path
+
+
+def tree_entry_key(entry):
+    # Git orders tree entries by name, comparing a subtree as if its name
+    # ended in a slash.
+    name = to_bytes(entry[3])
+    if entry[1] == 'tree':
+        return name + b'/'
+    return name
+
+
+def encode_tree(entries):
+    """Return the raw contents of a tree object holding ENTRIES, a list of
+    (mode, type, name, path) tuples as given to 'git mktree'."""
+    data = []
+    for mode, kind, name, path in sorted(entries, key=tree_entry_key):
+        data.append(b''.join((mode.lstrip('0').encode('ascii'), b' ',
+                              to_bytes(path), b'\0',
+                              binascii.unhexlify(name))))
+    return b''.join(data)
+
+
+class gitimporter(object):
+    """Streams objects into the repository through a single 'git fast-import'
+    process.  Commits are made on a scratch ref which is reset before the
+    stream ends, so fast-import never updates a ref itself; callers read
+    back the names they need with query() and update refs on their own."""
+    scratch_ref = 'refs/gitshelve/fast-import'
+
+    def __init__(self, repository=None, stats=None, algorithm='sha1'):
+        self.stats = stats
+        self.algorithm = algorithm
+        self.start = time.time()
+        self.bytes_in = self.bytes_out = 0
+        self.proc = Popen(('git', 'fast-import', '--quiet', '--done'),
+                          env=git_environ(repository),
+                          stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self.written = set()
+
+    def write(self, data):
+        data = to_bytes(data)
+        self.bytes_in += len(data)
+        try:
+            self.proc.stdin.write(data)
+        except (IOError, OSError, ValueError):
+            self.abort()
+
+    def data(self, data):
+        data = to_bytes(data)
+        self.write('data %d\n' % len(data))
+        self.write(data)
+        self.write('\n')
+
+    def blob(self, data):
+        """Write DATA as a blob, returning its name."""
+        name = hash_object('blob', data, self.algorithm)
+        if name not in self.written:
+            self.written.add(name)
+            self.write('blob\n')
+            self.data(data)
+        return name
+
+    def query(self, command):
+        """Send COMMAND, one that replies with a line, and return the reply."""
+        self.write(command + '\n')
+        try:
+            self.proc.stdin.flush()
+            response = self.proc.stdout.readline()
+        except (IOError, OSError, ValueError):
+            response = None
+        if not response:
+            self.abort()
+        self.bytes_out += len(response)
+        return to_unicode(response).rstrip('\n')
+
+    def abort(self):
+        """Give up on the stream after fast-import stopped accepting it, and
+        raise the error it reported."""
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.finish()
+        raise GitError('fast-import', [], {}, 'stream ended unexpectedly')
+
+    def record(self, failed):
+        record_git(self.stats, 'fast-import', (), time.time() - self.start,
+                   bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                   failed=failed)
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        self.record(True)
+
+    def finish(self):
+        err = self.proc.stderr.read()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        returncode = self.proc.wait()
+        self.record(returncode != 0)
+        if returncode != 0:
+            raise GitError('fast-import', [], {}, to_unicode(err), returncode)
+
+    def close(self):
+        self.write('reset %s\n\ndone\n' % self.scratch_ref)
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            self.abort()
+        self.finish()
+
+
+def inflate(buf, offset, size):
+    """Decompress the zlib stream starting at OFFSET in BUF, which is known
+    to inflate to SIZE bytes."""
+    decompressor = zlib.decompressobj()
+    chunks = []
+    length = 0
+    step = max(size, 4096)
+    while True:
+        chunk = decompressor.decompress(buf[offset:offset + step])
+        offset += step
+        chunks.append(chunk)
+        length += len(chunk)
+        if length >= size or offset >= len(buf) or \
+           decompressor.unused_data:
+            break
+    data = b''.join(chunks)
+    if len(data) != size:
+        raise ValueError("corrupt object: inflated %d bytes, expected %d"
+                         % (len(data), size))
+    return data
+
+
+def apply_delta(base, delta):
+    """Rebuild an object from its BASE and a Git pack DELTA."""
+    delta = bytearray(delta)
+    pos = 0
+    for _ in range(2):  # source size, then result size
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        if _ == 0 and size != len(base):
+            raise ValueError("corrupt delta: base size mismatch")
+    result_size = size
+
+    result = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            result += base[offset:offset + size]
+        elif op:
+            result += delta[pos:pos + op]
+            pos += op
+        else:
+            raise ValueError("corrupt delta: opcode 0")
+    if len(result) != result_size:
+        raise ValueError("corrupt delta: result size mismatch")
+    return bytes(result)
+
+
+class gitpack(object):
+    """A memory-mapped packfile and its version 2 index.  Both files are
+    mapped read-only, so every process reading the same pack shares its
+    pages through the OS page cache."""
+    types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+    OFS_DELTA = 6
+    REF_DELTA = 7
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + '.pack'
+        self.idx = self.map(idx_path)
+        if self.idx[:8] != b'\377tOc\0\0\0\2':
+            raise ValueError("%s: unsupported index version" % idx_path)
+        self.pack = self.map(self.pack_path)
+        self.fanout = struct.unpack('>256I', self.idx[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.names_offset = 8 + 1024
+        self.offsets_offset = self.names_offset + 24 * self.count
+        self.large_offsets_offset = self.offsets_offset + 4 * self.count
+
+    def map(self, path):
+        f = io.open(path, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def find(self, sha):
+        """Return the pack offset of the object with binary name SHA, or
+        None if it isn't in this pack."""
+        first = ord(sha[0:1])
+        lo = first and self.fanout[first - 1] or 0
+        hi = self.fanout[first]
+        idx = self.idx
+        base = self.names_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + 20 * mid
+            name = idx[pos:pos + 20]
+            if name < sha:
+                lo = mid + 1
+            elif name > sha:
+                hi = mid
+            else:
+                pos = self.offsets_offset + 4 * mid
+                offset = struct.unpack('>I', idx[pos:pos + 4])[0]
+                if offset & 0x80000000:
+                    pos = self.large_offsets_offset + \
+                        8 * (offset & 0x7fffffff)
+                    offset = struct.unpack('>Q', idx[pos:pos + 8])[0]
+                return offset
+        return None
+
+    def entry(self, offset):
+        """Parse the entry header at OFFSET, returning (type, size, base,
+        data offset), where BASE is the delta base (a pack offset or a
+        binary name) if the entry is a delta."""
+        pack = self.pack
+        byte = ord(pack[offset:offset + 1])
+        offset += 1
+        kind = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = ord(pack[offset:offset + 1])
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if kind == self.OFS_DELTA:
+            byte = ord(pack[offset:offset + 1])
+            offset += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(pack[offset:offset + 1])
+                offset += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base = distance
+        elif kind == self.REF_DELTA:
+            base = pack[offset:offset + 20]
+            offset += 20
+        return kind, size, base, offset
+
+
+class gitobjectdb(object):
+    """Reads and writes objects straight from a repository's object
+    directory, without running Git.
+
+    Writing does in-process what 'git hash-object -w' would do: hash the
+    header and data, zlib-compress them, and rename a temporary file into
+    place under objects/xx/.  Reading looks the object up in the
+    memory-mapped packfiles, resolving deltas through a small cache of
+    recently used bases, and then among the loose objects."""
+    compression = 1  # Git's default for core.looseCompression
+    cache_size = 64  # number of delta bases kept in memory
+
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        self.packs = None
+        self.pack_names = set()
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def locate(cls, repository=None, stats=None):
+        """Return a gitobjectdb for REPOSITORY (or the current repository),
+        or None if its layout isn't one this class knows how to write."""
+        try:
+            git_dir = git('rev-parse', '--git-common-dir',
+                          repository=repository, stats=stats)
+        except GitError:
+            return None
+        git_dir = os.path.abspath(git_dir)
+        if read_object_format(git_dir) != 'sha1':
+            return None
+        objects_dir = os.environ.get('GIT_OBJECT_DIRECTORY',
+                                     os.path.join(git_dir, 'objects'))
+        if not os.path.isdir(objects_dir):
+            return None
+        return cls(objects_dir)
+
+    locate = classmethod(locate)
+
+    def write(self, kind, data):
+        """Store DATA as an object of type KIND, returning its name."""
+        name = hash_object(kind, data)
+        directory = os.path.join(self.objects_dir, name[:2])
+        path = os.path.join(directory, name[2:])
+        if os.path.exists(path):
+            return name
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        compressor = zlib.compressobj(self.compression)
+        fd, tmp = tempfile.mkstemp(prefix='tmp_obj_', dir=directory)
+        try:
+            try:
+                os.write(fd, compressor.compress(object_header(kind, data)))
+                os.write(fd, compressor.compress(data))
+                os.write(fd, compressor.flush())
+            finally:
+                os.close(fd)
+            os.chmod(tmp, 0o444)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # someone else wrote the same object first
+                if not os.path.exists(path):
+                    raise
+                os.unlink(tmp)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return name
+
+    def scan_packs(self):
+        """Map any packfiles that appeared since the last scan, and unmap
+        those that have gone, replaced by a repack.  Packs whose index this
+        class can't read are skipped, and left to Git."""
+        if self.packs is None:
+            self.packs = []
+        pattern = os.path.join(self.objects_dir, 'pack', 'pack-*.idx')
+        idx_paths = sorted(glob.glob(pattern))
+        present = set(idx_paths)
+        packs = []
+        for pack in self.packs:
+            if pack.idx_path in present:
+                packs.append(pack)
+            else:
+                pack.close()
+        self.packs = packs
+        self.pack_names &= present
+        found = False
+        for idx_path in idx_paths:
+            if idx_path in self.pack_names:
+                continue
+            self.pack_names.add(idx_path)
+            try:
+                self.packs.append(gitpack(idx_path))
+                found = True
+            except (IOError, OSError, ValueError):
+                pass
+        return found
+
+    def close(self):
+        for pack in self.packs or []:
+            pack.close()
+        self.packs = None
+        self.pack_names = set()
+        self.cache.clear()
+
+    def read_loose(self, name):
+        path = os.path.join(self.objects_dir, name[:2], name[2:])
+        try:
+            f = io.open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            raw = zlib.decompress(f.read())
+        finally:
+            f.close()
+        header, _, data = raw.partition(b'\0')
+        kind, size = header.split()
+        if int(size) != len(data):
+            raise ValueError("corrupt loose object %s" % name)
+        return to_unicode(kind), data
+
+    def cached(self, key):
+        self.lock.acquire()
+        try:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.pop(key)
+                self.cache[key] = result
+            return result
+        finally:
+            self.lock.release()
+
+    def remember(self, key, result):
+        self.lock.acquire()
+        try:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def read_packed(self, pack, offset):
+        # Follow the chain of delta bases down to one that is cached or
+        # isn't a delta, keeping each delta on the way, and then apply
+        # them in turn on the way back up.  Chains may be thousands of
+        # entries deep, so this is a loop rather than a recursion.
+        deltas = []
+        while True:
+            key = (pack.pack_path, offset)
+            result = self.cached(key)
+            if result is not None:
+                break
+            kind, size, base, data_offset = pack.entry(offset)
+            data = inflate(pack.pack, data_offset, size)
+            if kind == gitpack.OFS_DELTA:
+                deltas.append((key, data))
+                offset -= base
+            elif kind == gitpack.REF_DELTA:
+                deltas.append((key, data))
+                found = self.find_packed(base)
+                if found is None:
+                    result = self.read_binary(base)
+                    if result is None:
+                        raise ValueError("delta base %s missing"
+                                         % to_unicode(binascii.hexlify(base)))
+                    break
+                pack, offset = found
+            else:
+                result = (gitpack.types[kind], data)
+                if deltas:
+                    self.remember(key, result)
+                break
+
+        kind, data = result
+        while deltas:
+            key, delta = deltas.pop()
+            data = apply_delta(data, delta)
+            # Only bases are worth keeping: they are what delta chains
+            # share.
+            if deltas:
+                self.remember(key, (kind, data))
+        return kind, data
+
+    def find_packed(self, sha):
+        for pack in self.packs:
+            offset = pack.find(sha)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def read_binary(self, sha):
+        if self.packs is None:
+            self.scan_packs()
+        found = self.find_packed(sha)
+        if found is None:
+            result = self.read_loose(to_unicode(binascii.hexlify(sha)))
+            if result is not None:
+                return result
+            # The object may have been packed since we last looked.
+            if not self.scan_packs():
+                return None
+            found = self.find_packed(sha)
+            if found is None:
+                return None
+        return self.read_packed(*found)
+
+    def read(self, name):
+        """Return (type, data) for the object called NAME, or None if it
+        can't be found here."""
+        return self.read_binary(binascii.unhexlify(name))
+
+
+def format_offset(seconds_east):
+    sign = '+'
+    if seconds_east < 0:
+        sign, seconds_east = '-', -seconds_east
+    return '%s%02d%02d' % (sign, seconds_east // 3600,
+                           seconds_east // 60 % 60)
+
+
+class gitrefs(object):
+    """Reads and updates refs by working on the files of the repository
+    directly, the way Git itself does: loose refs under refs/, then
+    'packed-refs'.  An update takes the ref's '.lock' file, checks the old
+    value under the lock, appends to the ref's reflog (starting one where
+    core.logAllRefUpdates asks for it), and renames the lock into place."""
+
+    def __init__(self, git_dir, repository=None, stats=None):
+        self.git_dir = git_dir
+        self.repository = repository
+        self.stats = stats
+        self.packed = None
+        self.packed_signature = None
+        self.ident = None
+        self.log_all = None
+
+    def locate(cls, repository=None, stats=None):
+        """Return a gitrefs for REPOSITORY (or the current repository), or
+        None if its refs are not kept in files."""
+        try:
+            git_dir = git('rev-parse', '--git-common-dir',
+                          repository=repository, stats=stats)
+        except GitError:
+            return None
+        git_dir = os.path.abspath(git_dir)
+        if os.path.isdir(os.path.join(git_dir, 'reftable')):
+            return None
+        config = os.path.join(git_dir, 'config')
+        if os.path.isfile(config):
+            f = io.open(config, encoding='utf-8', errors='replace')
+            try:
+                for line in f:
+                    line = line.strip().lower().replace(' ', '')
+                    if line.startswith('refstorage=') and \
+                       line != 'refstorage=files':
+                        return None
+            finally:
+                f.close()
+        return cls(git_dir, repository, stats)
+
+    locate = classmethod(locate)
+
+    def path(self, *parts):
+        return os.path.join(self.git_dir, *parts)
+
+    def read_packed(self):
+        """Return a dict mapping the names of the packed refs to their
+        values, reading 'packed-refs' again only if it has changed."""
+        path = self.path('packed-refs')
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        signature = (st.st_ino, st.st_size, st.st_mtime)
+        if signature != self.packed_signature:
+            packed = {}
+            f = io.open(path, encoding='utf-8')
+            try:
+                for line in f:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    name, _, ref = line.rstrip('\n').partition(' ')
+                    packed[ref] = name
+            finally:
+                f.close()
+            self.packed, self.packed_signature = packed, signature
+        return self.packed
+
+    def resolve(self, ref):
+        """Follow REF through any symbolic refs, returning the name of the
+        ref finally reached and its value, or None for the value if it
+        doesn't exist."""
+        for depth in range(5):
+            try:
+                f = io.open(self.path(*ref.split('/')), encoding='utf-8')
+            except (IOError, OSError):
+                return ref, self.read_packed().get(ref)
+            try:
+                value = f.read().strip()
+            finally:
+                f.close()
+            if not value.startswith('ref:'):
+                return ref, value
+            ref = value[4:].strip()
+        raise GitError('rev-parse', [ref], {}, 'symbolic ref loop', 128)
+
+    def read(self, ref):
+        return self.resolve(ref)[1]
+
+    def get_ident(self):
+        # Only the name and email are reused; the time is always now.
+        if self.ident is None:
+            ident = git('var', 'GIT_COMMITTER_IDENT',
+                        repository=self.repository, stats=self.stats)
+            self.ident = ident.rsplit(' ', 2)[0]
+        if time.localtime().tm_isdst and time.daylight:
+            offset = -time.altzone
+        else:
+            offset = -time.timezone
+        return '%s %d %s' % (self.ident, int(time.time()),
+                             format_offset(offset))
+
+    def should_log(self, ref):
+        """Return True if an update of REF should start a reflog for it
+        when it has none, following core.logAllRefUpdates."""
+        if self.log_all is None:
+            try:
+                setting = git('config', 'core.logAllRefUpdates',
+                              repository=self.repository, stats=self.stats)
+            except GitError:
+                setting = git('rev-parse', '--is-bare-repository',
+                              repository=self.repository,
+                              stats=self.stats) == 'false' and 'true' or ''
+            self.log_all = setting.lower()
+        if self.log_all == 'always':
+            return True
+        if self.log_all not in ('true', 'yes', 'on', '1'):
+            return False
+        return ref == 'HEAD' or ref.startswith('refs/heads/') or \
+            ref.startswith('refs/remotes/') or ref.startswith('refs/notes/')
+
+    def update(self, ref, new, old=None):
+        """Set REF to NEW.  Unless OLD is None, fail with a GitError if the
+        ref's current value isn't OLD; as with 'git update-ref', OLD may be
+        the null name, for a REF that must not exist yet."""
+        ref = self.resolve(ref)[0]
+        path = self.path(*ref.split('/'))
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        lock = path + '.lock'
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 438)
+        except OSError:
+            raise GitError('update-ref', [ref, new], {},
+                           "unable to lock %s" % lock, 128)
+        try:
+            try:
+                current = self.resolve(ref)[1]
+                if old is not None and \
+                        current != (old.strip('0') and old or None):
+                    raise GitError('update-ref', [ref, new, old], {},
+                                   "%s is at %s but expected %s" %
+                                   (ref, current, old), 128)
+                os.write(fd, (new + '\n').encode('ascii'))
+            finally:
+                os.close(fd)
+            log = self.path('logs', *ref.split('/'))
+            if os.path.isfile(log) or self.should_log(ref):
+                if not os.path.isdir(os.path.dirname(log)):
+                    os.makedirs(os.path.dirname(log))
+                null_name = '0' * len(new)
+                entry = '%s %s %s\n' % (current or null_name, new,
+                                        self.get_ident())
+                f = io.open(log, 'ab')
+                try:
+                    f.write(entry.encode('utf-8'))
+                finally:
+                    f.close()
+            os.rename(lock, path)
+        except:
+            try:
+                os.unlink(lock)
+            except OSError:
+                pass
+            raise
+
+
+class gitlock(object):
+    """An advisory lock on a file, taken with flock(), that lets shelves in
+    any number of processes take turns committing to a branch.
+
+    flock() doesn't queue its waiters, so rather than block in it a waiter
+    polls, sleeping for a random time between polls that grows up to
+    max_backoff.  Keeping max_backoff small keeps any one waiter from
+    being overtaken for long, at the cost of waking more often.  With a
+    timeout, acquire() gives up with a GitError after that many seconds."""
+
+    def __init__(self, path, timeout=None, max_backoff=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.fd = None
+
+    def open_file(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0)
+        return os.open(self.path, flags, 438)
+
+    def acquire(self):
+        fd = self.open_file()
+        start = time.time()
+        delay = min(0.001, self.max_backoff)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    pass
+                if self.timeout is not None and \
+                        time.time() - start + delay > self.timeout:
+                    raise GitError('update-ref', [self.path], {},
+                                   "timed out waiting for %s" % self.path,
+                                   128)
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.max_backoff)
+        except:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def release(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def parse_ls_tree_entry(entry):
+    """Split one entry of 'ls-tree -z' output into (mode, type, name, path).
+    Each entry is "<mode> <type> <name>\t<path>", where the mode is six
+    digits and the name forty hex digits (sixty-four in a SHA-256
+    repository), so the fields can be sliced out at fixed offsets."""
+    tab = 52
+    if entry[tab:tab + 1] != b'\t':
+        tab = 76
+    if entry[6:7] != b' ' or entry[11:12] != b' ' or \
+            entry[tab:tab + 1] != b'\t':
+        raise ValueError("ls-tree went insane: %s" % to_unicode(entry))
+    return (to_unicode(entry[:6]), to_unicode(entry[7:11]),
+            to_unicode(entry[12:tab]), to_unicode(entry[tab + 1:]))
+
+
+class gitindex(object):
+    """A compact listing of every entry beneath a commit's tree, used by
+    compact shelves in place of nested dicts.  The paths are kept in one
+    sorted list, alongside a bytearray of binary names (20 bytes each, or
+    32 in a SHA-256 repository) and another holding a type byte for each
+    entry, so a directory's contents are one contiguous range found by
+    bisection."""
+    TREE = ord('t')
+    BLOB = ord('b')
+
+    def __init__(self):
+        self.paths = []
+        self.names = bytearray()
+        self.kinds = bytearray()
+        self.width = 20
+
+    def __len__(self):
+        return len(self.paths)
+
+    def append(self, path, kind, name):
+        if not self.paths:
+            self.width = len(name) // 2
+        self.paths.append(path)
+        self.names += binascii.unhexlify(name)
+        self.kinds.append(ord(kind[0]))
+
+    def finish(self):
+        """Sort the entries by path.  'ls-tree -r' lists them in Git's tree
+        order instead, where a directory sorts as if its name ended in a
+        slash."""
+        paths, names, kinds = self.paths, self.names, self.kinds
+        order = sorted(range(len(paths)), key=paths.__getitem__)
+        self.paths = [paths[i] for i in order]
+        self.names = bytearray(len(names))
+        self.kinds = bytearray(len(kinds))
+        width = self.width
+        for new, old in enumerate(order):
+            self.names[width * new:width * (new + 1)] = \
+                names[width * old:width * (old + 1)]
+            self.kinds[new] = kinds[old]
+
+    def name(self, i):
+        width = self.width
+        return to_unicode(binascii.hexlify(bytes(
+            self.names[width * i:width * (i + 1)])))
+
+    def is_tree(self, i):
+        return self.kinds[i] == self.TREE
+
+    def range(self, path):
+        """Return the range of entries beneath the directory PATH."""
+        if not path:
+            return 0, len(self.paths)
+        # Everything under "dir/" sorts before "dir" followed by the
+        # character after the separator.
+        lo = bisect.bisect_left(self.paths, path + os.sep)
+        hi = bisect.bisect_left(self.paths, path + chr(ord(os.sep) + 1), lo)
+        return lo, hi
+
+    def children(self, path):
+        """Yield the index of each entry directly within the directory PATH,
+        '' being the top level, stepping over the contents of subtrees."""
+        prefix = path and path + os.sep
+        paths = self.paths
+        i, hi = self.range(path)
+        while i < hi:
+            rest = paths[i][len(prefix):]
+            sep = rest.find(os.sep)
+            if sep < 0:
+                yield i
+                i += 1
+            else:
+                i = bisect.bisect_left(
+                    paths, prefix + rest[:sep] + chr(ord(os.sep) + 1), i, hi)
+
+    def blobs(self, path):
+        """Yield the path of every blob beneath the directory PATH."""
+        lo, hi = self.range(path)
+        for i in range(lo, hi):
+            if self.kinds[i] == self.BLOB:
+                yield self.paths[i]
+
+
+class gitcache(object):
+    """Bounds how many loaded values a shelf keeps in memory.  Books holding
+    data read from (or written to) Git are remembered in least recently used
+    order.  Once there are more than max_entries of them, or their values
+    add up to more than max_bytes, the oldest drop their data and go back to
+    being just a name, to be read again when next needed.  A book that has
+    been changed since it was written is never evicted."""
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.books = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.books)
+
+    def stats(self):
+        return {'entries': len(self.books), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def hit(self, book):
+        self.lock.acquire()
+        try:
+            self.hits += 1
+            size = self.books.pop(book, None)
+            if size is not None:
+                self.books[book] = size
+        finally:
+            self.lock.release()
+
+    def add(self, book, size, miss=True):
+        """Remember that BOOK now holds SIZE bytes of data; a MISS means the
+        data had to be read from Git."""
+        self.lock.acquire()
+        try:
+            if miss:
+                self.misses += 1
+            self.size += size - self.books.pop(book, 0)
+            self.books[book] = size
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def discard(self, book):
+        self.lock.acquire()
+        try:
+            self.size -= self.books.pop(book, 0)
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        while self.books and \
+                ((self.max_entries is not None and
+                  len(self.books) > self.max_entries) or
+                 (self.max_bytes is not None and self.size > self.max_bytes)):
+            book, size = self.books.popitem(last=False)
+            self.size -= size
+            # A dirty book's data exists nowhere else; it is tracked again
+            # once a commit writes it.
+            if not book.dirty and book.name is not None:
+                book.data = None
+                self.evictions += 1
+
+
+class gitbook(object):
     """Abstracts a reference to a data file within a Git repository.  It also
     maintains knowledge of whether the object has been modified or not."""
+    __slots__ = ('shelf', 'path', 'name', 'data', 'dirty')
+
     def __init__(self, shelf, path, name=None):
         self.shelf = shelf
         self.path = path
@@ -146,11 +1472,18 @@ class gitbook:
                (self.path, self.name, self.dirty)
 
     def get_data(self):
-        if self.data is None:
+        cache = getattr(self.shelf, 'cache', None)
+        data = self.data
+        if data is None:
             if self.name is None:
                 raise ValueError("name and data are both None")
-            self.data = self.deserialize_data(self.shelf.get_blob(self.name))
-        return self.data
+            blob = self.shelf.get_blob(self.name)
+            data = self.data = self.deserialize_data(blob)
+            if cache is not None:
+                cache.add(self, len(blob))
+        elif cache is not None:
+            cache.hit(self)
+        return data
 
     def set_data(self, data):
         if data != self.data:
@@ -168,15 +1501,149 @@ class gitbook:
         return None
 
     def __getstate__(self):
-        odict = self.__dict__.copy()  # copy the dict since we change it
-        del odict['dirty']  # remove dirty flag
+        odict = dict((key, getattr(self, key))
+                     for key in ('shelf', 'path', 'name', 'data'))
+        odict.update(getattr(self, '__dict__', {}))  # subclass attributes
         return odict
 
     def __setstate__(self, ndict):
-        self.__dict__.update(ndict)  # update attributes
+        self.data = self.name = None
+        for key, value in ndict.items():
+            setattr(self, key, value)
         self.dirty = False
 
 
+class gittree(dict):
+    """A directory of a lazily read shelf.  Until it is first looked into it
+    holds only its '__root__' name; then the shelf lists that one tree from
+    Git and fills in its entries, leaving any subtrees unread in turn.
+
+    Asking for '__root__' never reads the tree, so code that reuses the
+    cached names of unchanged trees can pass over it without a listing.
+
+    A tree of a compact shelf is filled in from the shelf's gitindex
+    instead of being listed from Git."""
+    shelf = None
+    path = None
+    index = None
+    loaded = True
+
+    def __init__(self, shelf, path, name, index=None):
+        dict.__init__(self)
+        dict.__setitem__(self, '__root__', name)
+        self.shelf = shelf
+        self.path = path
+        self.index = index
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.shelf.load_tree(self)
+
+    def __repr__(self):
+        if not self.loaded:
+            return '<gitshelve.gittree %s %s>' % (self.path, self['__root__'])
+        return dict.__repr__(self)
+
+    def __getitem__(self, key):
+        if key != '__root__':
+            self.load()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key != '__root__':
+            self.load()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if key != '__root__':
+            self.load()
+        return dict.__contains__(self, key)
+
+    # Everything else sees or changes the tree's entries, and so needs them
+    # read first.
+    def __setitem__(self, key, value):
+        self.load()
+        return dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.load()
+        return dict.__delitem__(self, key)
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+    def pop(self, *args):
+        self.load()
+        return dict.pop(self, *args)
+
+    def setdefault(self, *args):
+        self.load()
+        return dict.setdefault(self, *args)
+
+    def update(self, *args, **kwargs):
+        self.load()
+        return dict.update(self, *args, **kwargs)
+
+    def clear(self):
+        self.loaded = True
+        return dict.clear(self)
+
+
+def synchronized(method):
+    """Wrap the gitshelve METHOD so that it runs holding the shelf's mutex,
+    and so never at the same time as a commit from its autocommit
+    thread."""
+    def wrapper(self, *args, **kwargs):
+        self.mutex.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.mutex.release()
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def synchronized_iterator(method):
+    """Wrap the gitshelve generator METHOD so that each item is produced
+    holding the shelf's mutex.  The lock is not held between items, so the
+    caller may change the shelf while iterating, as with a dict."""
+    def wrapper(self, *args, **kwargs):
+        iterator = method(self, *args, **kwargs)
+        while True:
+            self.mutex.acquire()
+            try:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            finally:
+                self.mutex.release()
+            yield item
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
 class gitshelve(dict):
     """This class implements a Python "shelf" using a branch within a Git
     repository.  There is no "writeback" argument, meaning changes are only
@@ -185,105 +1652,784 @@ class gitshelve(dict):
     This implementation uses a dictionary of gitbook objects, since we don't
     really want to use Pickling within a Git repository (it's not friendly to
     other Git users, nor does it support merging)."""
-    ls_tree_pat = \
-        re.compile(r'((\d{6}) (tree|blob)) ([0-9a-f]{40})\t(start|(.+))$')
+    read_chunk_size = 65536
 
     head = None
+    head_read = False
     dirty = False
     objects = {}
     book_type = gitbook
     branch = 'master'
     repository = None
     keep_history = True
+    commit_engine = 'git'
+    backend = 'git'
+    lazy = False
+    compact = False
+    reader = None
+    objectdb = None
+    refs = None
+    cache = None
+    cache_entries = None
+    cache_bytes = None
+    stats = None
+    workers = 1
+    defer_writes = False
+    max_pending_bytes = 16 << 20
+    pending = ()
+    pending_bytes = 0
+    changed = ()
+    retries = 0
+    retry_backoff = 0.01
+    commit_lock = False
+    lock_timeout = None
+    lock_backoff = 0.05
+    branch_lock = None
+    object_format = None
+    autocommit_keys = None
+    autocommit_bytes = None
+    autocommit_interval = None
+    autocommitter = None
+    autocommit_error = None
+    sequence = 0
+    committed_sequence = 0
+    dirty_bytes = 0
+    dirty_since = None
+    flush_requested = False
 
     def __init__(self, branch='master', repository=None,
-                 keep_history=True, book_type=gitbook):
+                 keep_history=True, book_type=gitbook, commit_engine='git',
+                 backend='git', lazy=False, compact=False,
+                 cache_entries=None, cache_bytes=None, workers=1,
+                 defer_writes=False, max_pending_bytes=16 << 20,
+                 retries=0, retry_backoff=0.01, commit_lock=False,
+                 lock_timeout=None, lock_backoff=0.05, autocommit_keys=None,
+                 autocommit_bytes=None, autocommit_interval=None):
         self.branch = branch
+        self.mutex = threading.RLock()
+        self.committed = threading.Condition(self.mutex)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        if commit_lock and fcntl is None:
+            raise ValueError("commit_lock needs fcntl.flock()")
+        self.commit_lock = commit_lock
+        self.lock_timeout = lock_timeout
+        self.lock_backoff = lock_backoff
+        self.workers = workers
+        self.defer_writes = defer_writes
+        self.max_pending_bytes = max_pending_bytes
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        self.init_cache()
+        self.stats = gitstats()
+        self.lazy = lazy
+        self.compact = compact
         self.repository = repository
         self.keep_history = keep_history
         self.book_type = book_type
+        if commit_engine not in ('git', 'fast-import'):
+            raise ValueError("unknown commit engine: %s" % commit_engine)
+        self.commit_engine = commit_engine
+        if backend not in ('git', 'python'):
+            raise ValueError("unknown backend: %s" % backend)
+        self.backend = backend
         self.init_data()
         dict.__init__(self)
+        self.autocommit_keys = autocommit_keys
+        self.autocommit_bytes = autocommit_bytes
+        self.autocommit_interval = autocommit_interval
+
+    def init_cache(self):
+        """Set up the value cache, if the shelf was given a limit on the
+        number or size of the values it keeps loaded."""
+        if self.cache_entries is None and self.cache_bytes is None:
+            self.cache = None
+        else:
+            self.cache = gitcache(self.cache_entries, self.cache_bytes)
+
+    def cache_stats(self):
+        """Return the value cache's counters, or None if it has none."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def remember(self, book, blob):
+        """Note that BOOK's data was just written as BLOB, so that the value
+        cache may evict it from now on."""
+        if self.cache is not None:
+            self.cache.add(book, len(blob), miss=False)
 
     def init_data(self):
         self.head = None
         self.dirty = False
         self.objects = {}
+        self.pending = []
+        self.pending_bytes = 0
+        self.changed = set()
+        self.dirty_bytes = 0
+        self.dirty_since = None
+
+    def start_autocommit(self):
+        """Start the thread that commits on the shelf's behalf, if it was
+        given any of autocommit_keys, autocommit_bytes (the size of the
+        values written) or autocommit_interval (in seconds): it commits
+        once that many keys have changed, that many bytes been written, or
+        that long passed since the first uncommitted write.
+
+        open() calls this once the branch has been read; a shelf made
+        directly should call it after read_repository()."""
+        if self.autocommit_keys is None and self.autocommit_bytes is None \
+                and self.autocommit_interval is None:
+            return
+        if self.autocommitter is not None:
+            return
+        self.autocommit_error = None
+        self.autocommitter = threading.Thread(target=self.autocommit)
+        self.autocommitter.daemon = True
+        self.autocommitter.start()
+
+    def commit_due(self):
+        """Return how many seconds remain before the autocommit thread
+        should commit, 0 if it should now, or None if nothing will make it
+        commit except more writes."""
+        if not self.dirty:
+            return None
+        if self.flush_requested:
+            return 0
+        if self.autocommit_keys is not None and \
+                len(self.changed) >= self.autocommit_keys:
+            return 0
+        if self.autocommit_bytes is not None and \
+                self.dirty_bytes >= self.autocommit_bytes:
+            return 0
+        if self.autocommit_interval is None or self.dirty_since is None:
+            return None
+        return max(0, self.dirty_since + self.autocommit_interval -
+                   time.time())
+
+    def autocommit(self):
+        self.mutex.acquire()
+        try:
+            while self.autocommitter is threading.current_thread():
+                due = self.commit_due()
+                if due == 0:
+                    try:
+                        self.commit()
+                    except Exception as e:
+                        # Leave the changes for the next write or close()
+                        # to try again, and tell anyone waiting on them.
+                        self.autocommit_error = e
+                        self.flush_requested = False
+                        self.committed.notify_all()
+                        self.committed.wait(self.autocommit_interval)
+                    continue
+                self.committed.wait(due)
+        finally:
+            self.mutex.release()
+
+    def mark_changed(self, path, size=0):
+        """Note that the value at PATH was set or deleted, SIZE bytes
+        being written, for rebase() and the autocommit thread."""
+        self.changed.add(path)
+        self.sequence += 1
+        self.dirty_bytes += size
+        first = self.dirty_since is None
+        if first:
+            self.dirty_since = time.time()
+        # the thread needs waking to commit now, or to start the clock
+        if self.autocommitter is not None and \
+                (first or self.commit_due() == 0):
+            self.committed.notify_all()
+
+    mark_changed = synchronized(mark_changed)
+
+    def wait_for_commit(self, sequence=None, timeout=None):
+        """Wait until the write numbered SEQUENCE, by default the latest,
+        has been committed, and return True; or return False if TIMEOUT
+        seconds pass first.  Writes are numbered from 1 in the order they
+        are made, and the number of the latest is kept in 'sequence'.
+
+        Without an autocommit thread, the shelf is committed right away.
+        With one, it is asked to commit now unless autocommit_interval
+        bounds the wait anyway; a GitError it hit meanwhile is raised."""
+        self.mutex.acquire()
+        try:
+            if sequence is None:
+                sequence = self.sequence
+            if self.committed_sequence >= sequence:
+                return True
+            if self.autocommitter is None:
+                self.commit()
+                return True
+            self.autocommit_error = None
+            if self.autocommit_interval is None:
+                self.flush_requested = True
+                self.committed.notify_all()
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.committed_sequence < sequence:
+                if self.autocommit_error is not None:
+                    raise self.autocommit_error
+                if deadline is None:
+                    self.committed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.committed.wait(remaining)
+            return True
+        finally:
+            self.mutex.release()
 
     def git(self, *args, **kwargs):
         if self.repository:
             kwargs['repository'] = self.repository
+        kwargs['stats'] = self.stats
         return git(*args, **kwargs)
 
+    def get_refs(self):
+        """Return the in-process ref store when the 'python' backend is
+        selected and the repository keeps its refs in files, else None."""
+        if self.backend != 'python':
+            return None
+        if self.refs is None or self.refs[0] != self.repository:
+            self.refs = (self.repository,
+                         gitrefs.locate(self.repository, self.stats))
+        return self.refs[1]
+
+    def get_object_format(self):
+        """Return the hash algorithm naming the repository's objects."""
+        if self.object_format is None or \
+                self.object_format[0] != self.repository:
+            try:
+                git_dir = os.path.abspath(self.git('rev-parse',
+                                                   '--git-common-dir'))
+                algorithm = read_object_format(git_dir)
+            except GitError:
+                algorithm = 'sha1'  # git creates it with the default
+            self.object_format = (self.repository, algorithm)
+        return self.object_format[1]
+
+    def get_branch_lock(self):
+        """Return the gitlock that commits to the branch hold, kept in the
+        repository's git dir, or None unless commit_lock was asked for."""
+        if not self.commit_lock:
+            return None
+        key = (self.repository, self.branch)
+        if self.branch_lock is None or self.branch_lock[0] != key:
+            git_dir = os.path.abspath(self.git('rev-parse',
+                                               '--git-common-dir'))
+            path = os.path.join(git_dir, 'gitshelve', 'locks',
+                                *self.branch.split('/'))
+            self.branch_lock = (key, gitlock(path))
+        lock = self.branch_lock[1]
+        lock.timeout = self.lock_timeout
+        lock.max_backoff = self.lock_backoff
+        return lock
+
     def current_head(self):
+        refs = self.get_refs()
+        if refs is not None:
+            head = refs.read('refs/heads/%s' % self.branch)
+            if head is None:
+                raise GitError('rev-parse', [self.branch], {},
+                               'unknown revision %s' % self.branch, 128)
+            return head
         return self.git('rev-parse', self.branch)
 
     def update_head(self, new_head):
-        if self.head:
+        # A branch found missing when the shelf was read must still be
+        # missing; the null name as the old value asks exactly that, so a
+        # first commit made elsewhere meanwhile is never overwritten.  A
+        # shelf that never read its branch simply replaces it.
+        old = self.head
+        if old is None and self.head_read:
+            old = '0' * len(new_head)
+        refs = self.get_refs()
+        if refs is not None:
+            refs.update('refs/heads/%s' % self.branch, new_head, old)
+        elif old is not None:
             self.git('update-ref', 'refs/heads/%s' % self.branch, new_head,
-                     self.head)
+                     old)
         else:
             self.git('update-ref', 'refs/heads/%s' % self.branch, new_head)
         self.head = new_head
 
-    def __parse_ls_tree_line(self, treep, perm, name, path):
-        parts = path.split(os.sep)
-        d = self.objects
-        for part in parts:
-            if not part in d:
-                d[part] = {}
-            d = d[part]
-
-        if treep:
-            d['__root__'] = name
+    def git_stream(self, *args, **kwargs):
+        if self.repository:
+            kwargs['repository'] = self.repository
+        kwargs['stats'] = self.stats
+        return git_stream(*args, **kwargs)
+
+    def ls_tree(self, *args):
+        """Yield (mode, type, name, path) for each entry listed by 'git
+        ls-tree -z ARGS'.  The listing is parsed as it streams in, so only
+        one chunk of it is ever held in memory."""
+        pending = b''
+        for chunk in self.git_stream('ls-tree', '-z', *args,
+                                     chunk_size=self.read_chunk_size):
+            entries = (pending + chunk).split(b'\0')
+            pending = entries.pop()
+            for entry in entries:
+                yield parse_ls_tree_entry(entry)
+        if pending:
+            yield parse_ls_tree_entry(pending)
+
+    def check_mode(self, mode, path):
+        if mode != '100644':
+            raise GitError('read_repository', [], {},
+                           ('Invalid mode for %s : ' +
+                            '100644 required, %s found') % (path, mode))
+
+    def list_tree(self, treeish, objects, path='', recursive=True):
+        """Read the tree TREEISH, found at PATH, into the dict OBJECTS.  If
+        RECURSIVE is false, just that one tree is listed, and its subtrees
+        are left as unread gittrees."""
+        if recursive:
+            args = ('--full-tree', '-r', '-t', treeish)
         else:
-            if perm == '100644':
-                d['__book__'] = self.book_type(self, path, name)
+            args = (treeish,)
+        self.fill_tree(self.ls_tree(*args), objects, path, recursive)
+
+    def fill_tree(self, entries, objects, path='', recursive=True,
+                  dirs=None):
+        """Add ENTRIES, as listed by ls_tree() for the tree at PATH, to the
+        dict OBJECTS.  A listing given in several parts is added by passing
+        the DIRS returned for one part along with the next."""
+        prefix = path and path + os.sep
+
+        # ls-tree lists every tree before its contents, so an entry's
+        # parent directory has always been seen already.
+        if dirs is None:
+            dirs = {path: objects}
+        for mode, kind, name, entry_path in entries:
+            entry_path = prefix + entry_path
+            parent, _, part = entry_path.rpartition(os.sep)
+            part = intern(part)
+            d = dirs[parent]
+            if kind == 'tree':
+                if recursive:
+                    tree = d.get(part)
+                    if tree is None:
+                        tree = d[part] = {}
+                    tree['__root__'] = name
+                else:
+                    tree = d[part] = gittree(self, entry_path, name)
+                dirs[entry_path] = tree
             else:
-                raise GitError('read_repository', [], {},
-                               'Invalid mode for %s : ' +
-                               '100644 required, %s found'
-                               % (path, perm))
+                self.check_mode(mode, entry_path)
+                d[part] = {'__book__': self.book_type(self, entry_path, name)}
+        return dirs
+
+    def fill_from_index(self, index, objects, path=''):
+        """Fill in the entries of the directory PATH from INDEX, leaving its
+        subtrees as unread gittrees."""
+        prefix = path and path + os.sep
+        for i in index.children(path):
+            entry_path = index.paths[i]
+            part = intern(entry_path[len(prefix):])
+            if index.is_tree(i):
+                objects[part] = gittree(self, entry_path, index.name(i),
+                                        index)
+            else:
+                objects[part] = {'__book__': self.book_type(
+                    self, entry_path, index.name(i))}
+
+    def read_index(self):
+        """Read the whole tree of the branch into a compact gitindex."""
+        index = gitindex()
+        for mode, kind, name, path in self.ls_tree('--full-tree', '-r', '-t',
+                                                   self.head):
+            if kind != 'tree':
+                self.check_mode(mode, path)
+            index.append(path, kind, name)
+        index.finish()
+        return index
+
+    def load_tree(self, tree):
+        """Fill in the entries of TREE, a gittree which hasn't been read
+        yet."""
+        if tree.index is not None:
+            self.fill_from_index(tree.index, tree, tree.path)
+        else:
+            self.list_tree(tree['__root__'], tree, tree.path, False)
 
     def read_repository(self):
         self.init_data()
+        self.head_read = True
         try:
             self.head = self.current_head()
         except GitError:
             return
+        if self.compact:
+            self.fill_from_index(self.read_index(), self.objects)
+        else:
+            self.list_tree(self.head, self.objects, recursive=not self.lazy)
+
+    read_repository = synchronized(read_repository)
+
+    def diff_tree(self, old, new):
+        """Yield (old_mode, new_mode, name, path) for every entry that
+        differs between the commits OLD and NEW, NAME being the entry's new
+        name.  Trees are listed as well as their contents, and before
+        them."""
+        pending = b''
+        meta = None
+        for chunk in self.git_stream('diff-tree', '-r', '-t', '-z', old, new,
+                                     chunk_size=self.read_chunk_size):
+            fields = (pending + chunk).split(b'\0')
+            pending = fields.pop()
+            for field in fields:
+                if meta is None:
+                    # ':old_mode new_mode old_name new_name status'
+                    meta = to_unicode(field[1:]).split()
+                else:
+                    yield meta[0], meta[1], meta[3], to_unicode(field)
+                    meta = None
 
-        ls_tree = self.git('ls-tree', '--full-tree', '-r', '-t', '-z',
-                           self.head).split('\0')
-        for line in ls_tree:
-            match = self.ls_tree_pat.match(line)
-            if not match:
-                raise ValueError("ls-tree went insane: %s" % line)
+    def find_tree(self, path):
+        """Return the directory at PATH, or None if there isn't one."""
+        d = self.objects
+        if path:
+            for part in path.split(os.sep):
+                d = d.get(part)
+                if not isinstance(d, dict) or \
+                        ('__book__' in d and len(d) == 1):
+                    return None
+        return d
 
-            treep = match.group(1) == "040000 tree"
-            perm = match.group(2)
-            name = match.group(4)
-            path = match.group(5)
-            self.__parse_ls_tree_line(treep, perm, name, path)
+    def is_book(self, obj):
+        """Return True if OBJ, an entry of some directory, holds a value
+        rather than a directory.  Unread trees are not read to tell."""
+        return not isinstance(obj, gittree) and '__book__' in obj
+
+    def drop_books(self, obj):
+        """Tell the value cache to forget every book in OBJ, which is being
+        replaced."""
+        if self.cache is None or not isinstance(obj, dict):
+            return
+        if '__book__' in obj:
+            self.cache.discard(obj['__book__'])
+        elif not isinstance(obj, gittree) or obj.loaded:
+            for book in self.walker('values', obj):
+                self.cache.discard(book)
+
+    def refresh(self):
+        """Bring the shelf up to date with its branch, after some other
+        shelf or process has committed to it.  Rather than read the whole
+        branch again, only the entries that differ between the old and new
+        head are replaced, so the values already loaded for everything else
+        are kept.  Returns the list of paths whose values changed, or None
+        if the whole branch had to be read again.
+
+        The shelf must have no uncommitted changes."""
+        if self.dirty:
+            raise ValueError("cannot refresh a shelf with uncommitted "
+                             "changes")
+        try:
+            head = self.current_head()
+        except GitError:
+            head = None
+        if head == self.head:
+            return []
+        if self.head is None or head is None:
+            self.read_repository()
+            return None
+
+        return self.apply_diff(self.diff_tree(self.head, head), head)
+
+    refresh = synchronized(refresh)
+
+    def apply_diff(self, diff, head, ours=()):
+        """Make the objects match HEAD by replacing the entries in DIFF, as
+        produced by diff_tree() from the current head, and return the paths
+        whose values changed.  Directories holding any of the paths in OURS
+        are kept rather than replaced, so that changes made on this shelf
+        survive; those paths themselves are left alone."""
+        dirs = set()
+        for path in ours:
+            parts = path.split(os.sep)[:-1]
+            for i in range(len(parts)):
+                dirs.add(os.sep.join(parts[:i + 1]))
+
+        changed = []
+        skip = None
+        for old_mode, new_mode, name, path in diff:
+            if old_mode not in ('000000', '040000') or \
+                    new_mode not in ('000000', '040000'):
+                changed.append(path)
+            if skip is not None and path.startswith(skip):
+                continue            # inside a tree replaced as a whole
+            skip = None
+            if path in ours:
+                continue
+            parent, _, part = path.rpartition(os.sep)
+            d = self.find_tree(parent)
+            if d is None:
+                continue
+            old = d.get(part)
+            if new_mode == '000000':
+                if path in dirs:
+                    continue        # its other entries are removed one by one
+                if not isinstance(old, dict) or \
+                        (old_mode == '040000') == self.is_book(old):
+                    # already replaced by an entry of the other kind, which
+                    # diff-tree can list first: a file 'top' sorts before
+                    # the tree 'top' it replaces
+                    continue
+                self.drop_books(old)
+                d.pop(part, None)
+                skip = path + os.sep
+            elif new_mode == '040000':
+                if isinstance(old, gittree) and not old.loaded:
+                    # never read, so it can simply be read from the new tree
+                    dict.__setitem__(old, '__root__', name)
+                    old.index = None
+                    skip = path + os.sep
+                elif isinstance(old, dict) and '__book__' not in old:
+                    old['__root__'] = name
+                else:
+                    self.drop_books(old)
+                    if (self.lazy or self.compact) and path not in dirs:
+                        d[part] = gittree(self, path, name)
+                        skip = path + os.sep
+                    else:
+                        d[part] = {'__root__': name}
+            else:
+                self.check_mode(new_mode, path)
+                self.drop_books(old)
+                d[part] = {'__book__': self.book_type(self, path, name)}
+                skip = path + os.sep
+
+        # the top-level tree is whatever the new head's is; make_tree()
+        # rebuilds it at the next commit
+        self.objects.pop('__root__', None)
+        # and the trees holding our own changes are rebuilt as well
+        for path in ours:
+            self.invalidate(path)
+        self.head = head
+        return changed
 
     def open(cls, branch='master', repository=None,
-             keep_history=True, book_type=gitbook):
-        shelf = gitshelve(branch, repository, keep_history, book_type)
+             keep_history=True, book_type=gitbook, **kwargs):
+        shelf = gitshelve(branch, repository, keep_history, book_type,
+                          **kwargs)
         shelf.read_repository()
+        shelf.start_autocommit()
         return shelf
 
     open = classmethod(open)
 
+    def get_reader(self):
+        if self.reader is None or self.reader.repository != self.repository:
+            self.close_reader()
+            self.reader = gitreader(self.repository, self.stats)
+        return self.reader
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def read_object(self, name):
+        """Return (type, data) for NAME, reading it in-process when the
+        'python' backend can, and through 'git cat-file' otherwise."""
+        objectdb = self.get_objectdb()
+        if objectdb is not None:
+            result = objectdb.read(name)
+            if result is not None:
+                return result
+        return self.get_reader().read(name)
+
     def get_blob(self, name):
-        return self.git('cat-file', 'blob', name, keep_newline=True)
+        kind, data = self.read_object(name)
+        if kind != 'blob':
+            raise GitError('cat-file', ['blob', name], {},
+                           'expected blob, found %s' % kind, 128)
+        return to_unicode(data)
+
+    def load_books(self, books):
+        """Fill in the data of every unloaded book in BOOKS, reading all of
+        their blobs in one pipelined request.  Returns the number of books
+        that were loaded."""
+        books = [book for book in books
+                 if book.data is None and book.name is not None]
+        if not books:
+            return 0
+        blobs = {}
+        objectdb = self.get_objectdb()
+        if objectdb is not None:
+            for book in books:
+                result = objectdb.read(book.name)
+                if result is not None:
+                    blobs[book.name] = result
+        missing = [book.name for book in books if book.name not in blobs]
+        if missing:
+            blobs.update(self.get_reader().read_many(missing))
+        for book in books:
+            kind, data = blobs[book.name]
+            if kind != 'blob':
+                raise GitError('cat-file', ['blob', book.name], {},
+                               'expected blob, found %s' % kind, 128)
+            book.data = book.deserialize_data(to_unicode(data))
+            if self.cache is not None:
+                self.cache.add(book, len(data))
+        return len(books)
+
+    def get_book(self, path):
+        try:
+            d = self.get_tree(path)
+        except KeyError:
+            raise KeyError(path)
+        if not d or not ('__book__' in d):
+            raise KeyError(path)
+        return d['__book__']
+
+    def get_many(self, paths):
+        """Return a dict mapping each of PATHS to its value, loading all of
+        the values not yet in memory at once."""
+        books = dict((path, self.get_book(path)) for path in paths)
+        self.load_books(books.values())
+        return dict((path, book.get_data()) for path, book in books.items())
+
+    get_many = synchronized(get_many)
+
+    def prefetch(self, paths_or_prefix=''):
+        """Load values ahead of time, so that later reads don't need to go
+        to Git one at a time.  Takes either a list of paths, or a directory
+        prefix naming a whole subtree (the empty string meaning the entire
+        shelf).  Returns the number of values that were loaded."""
+        if not isinstance(paths_or_prefix, string_types):
+            books = [self.get_book(path) for path in paths_or_prefix]
+        elif not paths_or_prefix:
+            books = self.itervalues()
+        else:
+            try:
+                d = self.get_tree(paths_or_prefix)
+            except KeyError:
+                raise KeyError(paths_or_prefix)
+            if '__book__' in d:
+                books = [d['__book__']]
+            else:
+                books = self.walker('values', d, paths_or_prefix)
+        return self.load_books(books)
+
+    prefetch = synchronized(prefetch)
+
+    def get_objectdb(self):
+        """Return the in-process object database when the 'python' backend
+        is selected and the repository layout supports it, else None."""
+        if self.backend != 'python':
+            return None
+        if self.objectdb is None or \
+           self.objectdb[0] != self.repository:
+            self.close_objectdb()
+            self.objectdb = (self.repository,
+                             gitobjectdb.locate(self.repository,
+                                                self.stats))
+        return self.objectdb[1]
+
+    def close_objectdb(self):
+        if self.objectdb is not None and self.objectdb[1] is not None:
+            self.objectdb[1].close()
+        self.objectdb = None
 
     def hash_blob(self, data):
+        if self.get_objectdb() is not None:
+            return hash_object('blob', to_bytes(data))
         return self.git('hash-object', '--stdin', input=data)
 
     def make_blob(self, data):
+        objectdb = self.get_objectdb()
+        if objectdb is not None:
+            return objectdb.write('blob', to_bytes(data))
         return self.git('hash-object', '-w', '--stdin', input=data)
 
-    def make_tree(self, objects):
+    def write_tree(self, entries):
+        """Write a tree holding ENTRIES, a list of (mode, type, name, path)
+        tuples, and return its name.  With the 'python' backend the tree
+        object is encoded and written in-process; otherwise it is piped to
+        'git mktree'."""
+        objectdb = self.get_objectdb()
+        if objectdb is not None:
+            return objectdb.write('tree', encode_tree(entries))
+
         buf = StringIO()
+        for entry in entries:
+            buf.write("%s %s %s\t%s\0" % entry)
+        return self.git('mktree', '-z', input=buf.getvalue())
+
+    def dirty_books(self, objects, books=None):
+        """Return a list of the dirty books in OBJECTS.  Only directories
+        without a cached '__root__' can hold any, so only they are walked."""
+        if books is None:
+            books = []
+        for path, obj in objects.items():
+            if path == '__root__' or '__root__' in obj:
+                continue
+            book = obj.get('__book__')
+            if book is not None and len(obj) == 1:
+                if book.dirty:
+                    books.append(book)
+            else:
+                self.dirty_books(obj, books)
+        return books
+
+    def map_workers(self, func, items):
+        """Return [func(item) for item in ITEMS], calling FUNC from up to
+        'workers' threads at once where concurrent.futures is available.
+        The object database is created beforehand, so that the threads
+        share it rather than racing to create their own."""
+        if self.workers > 1 and ThreadPoolExecutor is not None and \
+                len(items) > 1:
+            self.get_objectdb()
+            pool = ThreadPoolExecutor(min(self.workers, len(items)))
+            try:
+                return list(pool.map(func, items))
+            finally:
+                pool.shutdown()
+        return [func(item) for item in items]
+
+    def write_books(self, books):
+        """Write the blobs of BOOKS, several at once if the shelf has more
+        than one worker."""
+        blobs = [book.serialize_data(book.data) for book in books]
+        names = self.map_workers(self.make_blob, blobs)
+        for book, name, blob in zip(books, names, blobs):
+            book.name = name
+            book.dirty = False
+            self.remember(book, blob)
+
+    def dirty_trees(self, objects, levels=None, depth=0):
+        """Return a list holding, for each depth, the directories at that
+        depth of OBJECTS which have lost their cached '__root__'."""
+        if levels is None:
+            levels = []
+        if '__root__' in objects:
+            return levels
+        if len(levels) <= depth:
+            levels.append([])
+        levels[depth].append(objects)
+        for path, obj in objects.items():
+            if path != '__root__' and not \
+                    ('__book__' in obj and len(obj) == 1):
+                self.dirty_trees(obj, levels, depth + 1)
+        return levels
+
+    def write_trees(self, objects):
+        """Write the changed trees of OBJECTS a level at a time, deepest
+        first, so that the directories of each level, which only depend on
+        the levels below, can be written in parallel.  Does nothing unless
+        the shelf has more than one worker; make_tree() then writes them
+        one by one instead."""
+        if self.workers <= 1 or ThreadPoolExecutor is None:
+            return
+        for level in reversed(self.dirty_trees(objects)):
+            self.map_workers(self.make_tree, level)
+
+    def make_tree(self, objects):
+        entries = []
 
         root = objects.get('__root__')
 
@@ -295,26 +2441,26 @@ class gitshelve(dict):
             if not isinstance(obj, dict):
                 raise TypeError("objects['%s'] is not a dict" % path)
 
-            if len(list(obj.keys())) == 1 and '__book__' in obj:
+            if '__root__' in obj:
+                # Nothing beneath here has changed since the tree was last
+                # read or written; see invalidate().  Checking this first
+                # also leaves the subtrees of a lazy shelf unread.
+                entries.append(('040000', 'tree', obj['__root__'], path))
+            elif len(list(obj.keys())) == 1 and '__book__' in obj:
                 book = obj['__book__']
                 if book.dirty:
-                    book.name = self.make_blob(book.serialize_data(book.data))
+                    blob = book.serialize_data(book.data)
+                    book.name = self.make_blob(blob)
                     book.dirty = False
+                    self.remember(book, blob)
                     root = None
-                buf.write("100644 blob %s\t%s\0" % (book.name, path))
+                entries.append(('100644', 'blob', book.name, path))
             else:
-                tree_root = None
-                if '__root__' in obj:
-                    tree_root = obj['__root__']
-
-                tree_name = self.make_tree(obj)
-                if tree_name != tree_root:
-                    root = None
-
-                buf.write("040000 tree %s\t%s\0" % (tree_name, path))
+                entries.append(('040000', 'tree', self.make_tree(obj), path))
+                root = None
 
         if root is None:
-            name = self.git('mktree', '-z', input=buf.getvalue())
+            name = self.write_tree(entries)
             objects['__root__'] = name
             return name
         else:
@@ -332,17 +2478,237 @@ class gitshelve(dict):
         self.update_head(name)
         return name
 
+    def import_tree(self, importer, objects, prefix, trees, books):
+        """Return the fast-import 'M' lines describing OBJECTS, streaming the
+        blobs of dirty books as they are found.  Subtrees that still have
+        their cached name are unchanged, and are given by that name.  Every
+        tree that has to be rebuilt is appended to TREES, and every book
+        written to BOOKS."""
+        lines = []
+        for path in list(objects.keys()):
+            if path == '__root__':
+                continue
+
+            obj = objects[path]
+            if not isinstance(obj, dict):
+                raise TypeError("objects['%s'] is not a dict" % path)
+
+            full_path = prefix + path
+            if '__root__' in obj:
+                lines.append('M 040000 %s %s\n' %
+                             (obj['__root__'], fast_import_path(full_path)))
+            elif len(list(obj.keys())) == 1 and '__book__' in obj:
+                book = obj['__book__']
+                name = book.name
+                if book.dirty:
+                    blob = to_bytes(book.serialize_data(book.data))
+                    name = importer.blob(blob)
+                    books.append((book, name, blob))
+                lines.append('M 100644 %s %s\n' %
+                             (name, fast_import_path(full_path)))
+            else:
+                trees.append((full_path, obj))
+                lines.extend(self.import_tree(importer, obj, full_path + '/',
+                                              trees, books))
+        return lines
+
+    def get_idents(self):
+        idents = {}
+        for line in self.git('var', '-l').split('\n'):
+            key, _, value = line.partition('=')
+            if key in ('GIT_AUTHOR_IDENT', 'GIT_COMMITTER_IDENT'):
+                idents[key] = value
+        return idents['GIT_AUTHOR_IDENT'], idents['GIT_COMMITTER_IDENT']
+
+    def fast_import_commit(self, comment):
+        """Create the commit for the current objects by streaming every
+        dirty blob, the tree changes and the commit itself into one 'git
+        fast-import' process, then move the branch with update_head."""
+        author, committer = self.get_idents()
+        trees = [('', self.objects)]
+        books = []
+        importer = gitimporter(self.repository, self.stats,
+                               self.get_object_format())
+        try:
+            lines = self.import_tree(importer, self.objects, '', trees, books)
+            importer.write('reset %s\n' % importer.scratch_ref)
+            importer.write('commit %s\nmark :1\n' % importer.scratch_ref)
+            importer.write('author %s\ncommitter %s\n' % (author, committer))
+            importer.data(comment or '')
+            if self.head and self.keep_history:
+                importer.write('from %s\n' % self.head)
+            importer.write('deleteall\n')
+            importer.write(''.join(lines))
+            importer.write('\n')
+
+            name = importer.query('get-mark :1')
+            roots = []
+            for path, objects in trees:
+                if path:
+                    path = fast_import_path(path)
+                else:
+                    path = '""'
+                fields = importer.query('ls :1 %s' % path).split()
+                if fields[0] == 'missing':
+                    roots.append((objects, None))
+                else:
+                    roots.append((objects, fields[2]))
+        except GitError:
+            raise
+        except:
+            importer.kill()
+            raise
+        importer.close()
+
+        for objects, root in roots:
+            if root is None:
+                objects.pop('__root__', None)
+            else:
+                objects['__root__'] = root
+        for book, blob_name, blob in books:
+            book.name = blob_name
+            book.dirty = False
+            self.remember(book, blob)
+        # any blobs put() deferred went into the same stream
+        self.pending = []
+        self.pending_bytes = 0
+
+        self.update_head(name)
+        return name
+
     def commit(self, comment=None):
         if not self.dirty:
+            self.committed_sequence = self.sequence
             return self.head
 
-        # Walk the objects now, creating and nesting trees until we end up
-        # with a top-level tree.  We then create a commit out of this tree.
-        tree = self.make_tree(self.objects)
-        name = self.make_commit(tree, comment)
+        lock = self.get_branch_lock()
+        if lock is None:
+            return self.commit_changes(comment)
+        lock.acquire()
+        try:
+            # Whoever held the lock before us may have moved the branch;
+            # while we hold it, nobody else using the lock can.
+            self.rebase()
+            return self.commit_changes(comment)
+        finally:
+            lock.release()
+
+    commit = synchronized(commit)
+
+    def commit_changes(self, comment):
+        attempt = 0
+        while True:
+            try:
+                name = self.commit_objects(comment)
+                break
+            except GitConflict:
+                raise
+            except GitError as e:
+                if e.cmd != 'update-ref' or attempt >= self.retries:
+                    raise
+            # Another writer got there first: replay our changes onto its
+            # commit and try again, backing off so that writers which keep
+            # colliding spread out.
+            attempt += 1
+            time.sleep(random.uniform(0, self.retry_backoff *
+                                      (1 << (attempt - 1))))
+            self.rebase()
+
+        self.finish_commit()
+        return name
 
+    def finish_commit(self):
+        """Note that everything written so far has been committed, and wake
+        whoever is waiting for it."""
         self.dirty = False
-        return name
+        self.changed = set()
+        self.dirty_bytes = 0
+        self.dirty_since = None
+        self.flush_requested = False
+        self.committed_sequence = self.sequence
+        self.committed.notify_all()
+
+    finish_commit = synchronized(finish_commit)
+
+    def commit_objects(self, comment):
+        if self.commit_engine == 'fast-import':
+            return self.fast_import_commit(comment)
+
+        # Write every changed value first, and then every changed tree, so
+        # that each can be written in parallel.  Then walk the objects,
+        # nesting the trees until we end up with a top-level tree.  We then
+        # create a commit out of this tree.
+        self.flush_pending()
+        self.write_books(self.dirty_books(self.objects))
+        self.write_trees(self.objects)
+        tree = self.make_tree(self.objects)
+        return self.make_commit(tree, comment)
+
+    def rebase(self):
+        """Move the shelf onto the branch's current head, keeping the
+        changes made since the last commit.  Entries changed on the branch
+        are replaced as refresh() would, and the trees holding our own
+        changes are rebuilt at the next commit.  If the branch changed any
+        of the same keys, differently, GitConflict is raised naming them and
+        the shelf is left as it was.  Returns the paths the branch changed."""
+        try:
+            head = self.current_head()
+        except GitError:
+            head = None
+        if head == self.head:
+            return []
+        return self.replay(self.diff_tree(self.rebase_base(head), head),
+                           head)
+
+    def rebase_base(self, head):
+        """Return what rebase() diffs the branch's new HEAD from: the
+        shelf's own head, or the empty tree if the branch was created since
+        the shelf read it.  Raises GitConflict if it was deleted."""
+        if head is None:
+            raise GitConflict('update-ref', [self.branch], {}, [],
+                              "branch %s was deleted" % self.branch, 128)
+        if self.head is None:
+            return hash_object('tree', b'', self.get_object_format())
+        return self.head
+
+    def replay(self, diff, head):
+        """Do the work of rebase() given DIFF, the entries differing between
+        rebase_base() and HEAD, as diff_tree() yields them."""
+        diff = list(diff)
+        ours = self.changed
+        dirs = set()
+        for path in ours:
+            parts = path.split(os.sep)[:-1]
+            for i in range(len(parts)):
+                dirs.add(os.sep.join(parts[:i + 1]))
+        conflicts = set()
+        for old_mode, new_mode, name, path in diff:
+            if new_mode == '040000' or \
+                    (old_mode == '040000' and new_mode == '000000'):
+                continue
+            if path in ours:
+                parent, _, part = path.rpartition(os.sep)
+                d = (self.find_tree(parent) or {}).get(part) or {}
+                ours_name = None
+                if '__book__' in d:
+                    ours_name = d['__book__'].name
+                if new_mode == '000000':
+                    name = None
+                if ours_name != name:
+                    conflicts.add(path)
+            elif path in dirs:
+                conflicts.update(p for p in ours
+                                 if p.startswith(path + os.sep))
+            else:
+                parts = path.split(os.sep)[:-1]
+                for i in range(len(parts)):
+                    if os.sep.join(parts[:i + 1]) in ours:
+                        conflicts.add(os.sep.join(parts[:i + 1]))
+        if conflicts:
+            raise GitConflict('update-ref', [self.branch], {},
+                              sorted(conflicts),
+                              "%s has conflicting changes" % self.branch, 1)
+        return self.apply_diff(diff, head, ours)
 
     def sync(self):
         self.commit()
@@ -351,9 +2717,24 @@ class gitshelve(dict):
         r = self.git('rev-list', '--parents', '--max-count=1', self.branch)
         return r.split()[1:]
 
+    def stop_autocommit(self):
+        """Stop the autocommit thread, leaving any uncommitted changes for
+        commit() or close()."""
+        self.mutex.acquire()
+        try:
+            thread, self.autocommitter = self.autocommitter, None
+            self.committed.notify_all()
+        finally:
+            self.mutex.release()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
     def close(self):
+        self.stop_autocommit()
         if self.dirty:
             self.sync()
+        self.close_reader()
+        self.close_objectdb()
         del self.objects  # free it up right away
 
     def dump_objects(self, fd, indent=0, objects=None):
@@ -415,20 +2796,128 @@ class gitshelve(dict):
             raise KeyError(key)
         return d['__book__'].get_data()
 
+    get = synchronized(get)
+
+    def invalidate(self, path):
+        """Forget the cached tree names of every directory above PATH.  The
+        next commit only rebuilds trees that have lost their '__root__',
+        and reuses the cached name of everything else."""
+        d = self.objects
+        d.pop('__root__', None)
+        for part in path.split(os.sep)[:-1]:
+            d = d.get(part)
+            if d is None:
+                break
+            d.pop('__root__', None)
+
     def put(self, data):
         book = self.book_type(self, '__unknown__')
         book.data = data
-        book.name = self.make_blob(book.serialize_data(book.data))
-        book.dirty = False  # the blob was just written!
+        blob = book.serialize_data(book.data)
+        if not self.defer_writes:
+            book.name = self.make_blob(blob)
+            return self.store_book(book, blob)
+
+        # Only the name is needed now; the blob is written along with the
+        # others at the next commit, or once enough of them have piled up.
+        # Until then the book stays dirty, so the value cache keeps it.
+        book.name = hash_object('blob', to_bytes(blob),
+                                self.get_object_format())
+        self.store_book(book, blob, written=False)
+        self.pending.append((book, data, blob))
+        self.pending_bytes += len(blob)
+        if self.pending_bytes >= self.max_pending_bytes:
+            self.flush_pending()
+        return book.name
+
+    put = synchronized(put)
+
+    def put_many(self, values):
+        """Store each of VALUES, which may be any iterable, as put() does,
+        and return the list of their names.  The blobs are streamed through
+        a single 'git fast-import' (or written in-process with the 'python'
+        backend), and nothing is added to the shelf unless all of them were
+        written."""
+        objectdb = self.get_objectdb()
+        importer = None
+        if objectdb is None:
+            importer = gitimporter(self.repository, self.stats,
+                                   self.get_object_format())
+        books = []
+        try:
+            for data in values:
+                book = self.book_type(self, '__unknown__')
+                book.data = data
+                blob = book.serialize_data(book.data)
+                if importer is not None:
+                    book.name = importer.blob(to_bytes(blob))
+                else:
+                    book.name = objectdb.write('blob', to_bytes(blob))
+                books.append((book, blob))
+        except:
+            # a GitError from the importer means it has already exited
+            if importer is not None and importer.proc.poll() is None:
+                importer.kill()
+            raise
+        if importer is not None:
+            importer.close()
+        return [self.store_book(book, blob) for book, blob in books]
+
+    put_many = synchronized(put_many)
+
+    def flush_pending(self):
+        """Write the blobs deferred by put() in one batch: through a single
+        'git fast-import', or in-process with the 'python' backend.
+        Returns the number of blobs written."""
+        pending = [(book, blob) for book, data, blob in self.pending
+                   if book.dirty and book.data is data]
+        self.pending = []
+        self.pending_bytes = 0
+        if not pending:
+            return 0
+        objectdb = self.get_objectdb()
+        if objectdb is not None:
+            for book, blob in pending:
+                objectdb.write('blob', to_bytes(blob))
+        else:
+            importer = gitimporter(self.repository, self.stats,
+                                   self.get_object_format())
+            try:
+                for book, blob in pending:
+                    importer.blob(to_bytes(blob))
+            except GitError:
+                raise
+            except:
+                importer.kill()
+                raise
+            importer.close()
+        for book, blob in pending:
+            book.dirty = False
+            self.remember(book, blob)
+        return len(pending)
+
+    flush_pending = synchronized(flush_pending)
+
+    def store_book(self, book, blob, written=True):
+        """Add BOOK, whose data is the blob BLOB, to the shelf under a path
+        made from its name, as put() does.  Unless the blob has been
+        WRITTEN already, the book is left dirty."""
+        book.dirty = not written
         book.path = '%s/%s' % (book.name[:2], book.name[2:])
+        if written:
+            self.remember(book, blob)
 
         d = self.get_tree(book.path, make_dirs=True)
         d.clear()
         d['__book__'] = book
+        self.invalidate(book.path)
         self.dirty = True
+        self.mark_changed(book.path, len(blob))
 
         return book.name
 
+    store_book = synchronized(store_book)
+
     def __getitem__(self, path):
         d = None
         try:
@@ -441,13 +2930,36 @@ class gitshelve(dict):
         else:
             raise KeyError(path)
 
+    __getitem__ = synchronized(__getitem__)
+
     def __setitem__(self, path, data):
         d = self.get_tree(path, make_dirs=True)
         if '__book__' not in d:
             d.clear()
             d['__book__'] = self.book_type(self, path)
-        d['__book__'].set_data(data)
+        book = d['__book__']
+        if book.data is None and book.name is not None and not book.dirty:
+            # Rather than read the old value to compare it with the new one,
+            # compare the name the new one would have with the book's.
+            blob = book.serialize_data(data)
+            if hash_object('blob', to_bytes(blob),
+                           self.get_object_format()) == book.name:
+                book.data = data
+                self.remember(book, blob)
+                return
+        book.set_data(data)
+        if not book.dirty:
+            return              # the same value as before
+        if self.cache is not None:
+            self.cache.discard(book)
+        self.invalidate(path)
         self.dirty = True
+        size = 0
+        if self.autocommit_bytes is not None:
+            size = len(book.serialize_data(data))
+        self.mark_changed(path, size)
+
+    __setitem__ = synchronized(__setitem__)
 
     def prune_tree(self, objects, paths):
         if len(paths) > 1:
@@ -456,11 +2968,8 @@ class gitshelve(dict):
             # paths[0]
             has_root = '__root__' in objects[paths[0]]
             if left > 0 or len(objects[paths[0]]) > int(has_root):
-                if '__root__' in objects:
-                    del objects['__root__']
-                for tree in objects:
-                    if '__root__' in objects[tree]:
-                        del objects[tree]['__root__']
+                objects.pop('__root__', None)
+                objects[paths[0]].pop('__root__', None)
                 return 3
         l = len(objects[paths[0]])
         del objects[paths[0]]
@@ -469,14 +2978,24 @@ class gitshelve(dict):
 
     def __delitem__(self, path):
         try:
+            if self.cache is not None:
+                book = self.get_tree(path).get('__book__')
+                if book is not None:
+                    self.cache.discard(book)
             self.prune_tree(self.objects, path.split(os.sep))
         except KeyError:
             raise KeyError(path)
+        self.invalidate(path)
+        self.mark_changed(path)
+
+    __delitem__ = synchronized(__delitem__)
 
     def __contains__(self, path):
         d = self.get_tree(path)
         return len(list(d.keys())) == 1 and ('__book__' in d)
 
+    __contains__ = synchronized(__contains__)
+
     def walker(self, kind, objects, path=''):
         for item in list(objects.items()):
             if item[0] == '__root__':
@@ -489,7 +3008,13 @@ class gitshelve(dict):
             else:
                 key = item[0]
 
-            if len(list(item[1].keys())) == 1 and ('__book__' in item[1]):
+            if kind == 'keys' and isinstance(item[1], gittree) and \
+                    not item[1].loaded and item[1].index is not None:
+                # the keys of an unread compact tree come straight from the
+                # index, without building a book for each of them
+                for obj in item[1].index.blobs(key):
+                    yield obj
+            elif len(list(item[1].keys())) == 1 and ('__book__' in item[1]):
                 value = item[1]['__book__']
                 if kind == 'keys':
                     yield key
@@ -503,7 +3028,7 @@ class gitshelve(dict):
                 for obj in self.walker(kind, item[1], key):
                     yield obj
 
-        raise StopIteration
+    walker = synchronized_iterator(walker)
 
     def __iter__(self):
         return self.iterkeys()
@@ -535,24 +3060,181 @@ class gitshelve(dict):
             v.append(value)
         return v
 
+    def __reduce__(self):
+        # Pickle the shelf by its attributes alone.  As a dict subclass it
+        # would otherwise have its items() saved as well, to be replayed
+        # through __setitem__ before __setstate__ has run.
+        return (__newobj__, (self.__class__,), self.__getstate__())
+
     def __getstate__(self):
         self.sync()  # synchronize before persisting
         odict = self.__dict__.copy()  # copy the dict since we change it
         del odict['dirty']  # remove dirty flag
+        # neither the reader process, the mapped packs, the ref store, the
+        # branch lock, the value cache, the command stats nor the
+        # autocommit thread and its locks can be pickled
+        odict.pop('mutex', None)
+        odict.pop('committed', None)
+        odict.pop('autocommitter', None)
+        odict.pop('autocommit_error', None)
+        odict.pop('reader', None)
+        odict.pop('objectdb', None)
+        odict.pop('refs', None)
+        odict.pop('branch_lock', None)
+        odict.pop('cache', None)
+        odict.pop('stats', None)
         return odict
 
     def __setstate__(self, ndict):
         self.__dict__.update(ndict)  # update attributes
         self.dirty = False
-
-        # If the HEAD reference is out of date, throw away all data and
-        # rebuild it.
-        if not self.head or self.head != self.current_head():
-            self.read_repository()
+        self.mutex = threading.RLock()
+        self.committed = threading.Condition(self.mutex)
+        self.init_cache()
+        self.stats = gitstats()
+
+        # If the HEAD reference is out of date, bring the data up to date
+        # with it.
+        self.refresh()
+        self.start_autocommit()
+
+
+class gitwatcher(object):
+    """Watches the ref of a shelf's branch from a background thread, and
+    whenever it changes refreshes the shelf, or calls CALLBACK(shelf)
+    instead if one is given.  The callback runs on the watcher's thread;
+    refresh() holds the shelf's mutex, but a callback that changes the
+    shelf should take it too.
+
+    The loose ref file and 'packed-refs' are watched with inotify where it
+    is available; elsewhere they are stat()ed every INTERVAL seconds.
+    Either way, no Git process is run until the ref has actually changed.
+    The last exception raised by the refresh or callback is kept in
+    'error', and the change is looked at again at the next check, after at
+    most INTERVAL seconds."""
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+    events = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, shelf, callback=None, interval=1.0, use_inotify=True):
+        self.shelf = shelf
+        self.callback = callback
+        self.interval = interval
+        self.error = None
+        self.thread = None
+        self.stopping = threading.Event()
+        git_dir = os.path.abspath(shelf.git('rev-parse', '--git-common-dir'))
+        self.paths = [os.path.join(git_dir, 'refs', 'heads',
+                                   *shelf.branch.split('/')),
+                      os.path.join(git_dir, 'packed-refs')]
+        self.dirs = [git_dir, os.path.dirname(self.paths[0])]
+        self.libc = self.inotify = None
+        if use_inotify:
+            self.open_inotify()
+        self.signature = self.stat()
+
+    def open_inotify(self):
+        if ctypes is None:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return                  # not Linux
+        if fd >= 0:
+            self.libc, self.inotify = libc, fd
+            self.add_watches()
+
+    def add_watches(self):
+        # Watching a directory again is harmless, and picks up the ref's
+        # directory once a first commit has created it.
+        encoding = sys.getfilesystemencoding()
+        for path in self.dirs:
+            if os.path.isdir(path):
+                self.libc.inotify_add_watch(self.inotify,
+                                            path.encode(encoding),
+                                            self.events)
+
+    def stat(self):
+        signature = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def check(self):
+        """Refresh the shelf, or call the callback, if the ref has changed
+        since it was last looked at.  Returns True if it had."""
+        signature = self.stat()
+        if signature == self.signature:
+            return False
+        try:
+            if self.callback is not None:
+                self.callback(self.shelf)
+            else:
+                self.shelf.refresh()
+        except Exception as e:
+            # e.g. a shelf with uncommitted changes; try again next time
+            self.error = e
+            return True
+        self.signature = signature
+        self.error = None
+        return True
+
+    def wait(self):
+        if self.inotify is None:
+            self.stopping.wait(self.interval)
+            return
+        ready = select.select([self.inotify], [], [], self.interval)[0]
+        if ready:
+            try:
+                while os.read(self.inotify, 65536):
+                    pass
+            except OSError:
+                pass                # drained
+            self.add_watches()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wait()
+            if not self.stopping.is_set():
+                self.check()
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
 
 
 def open(branch='master', repository=None, keep_history=True,
-         book_type=gitbook):
-    return gitshelve.open(branch, repository, keep_history, book_type)
+         book_type=gitbook, **kwargs):
+    return gitshelve.open(branch, repository, keep_history, book_type,
+                          **kwargs)
 
 # gitshelve.py ends here
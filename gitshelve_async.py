@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# gitshelve_async.py
+#
+# An asyncio front end to gitshelve.  An asyncgitshelve wraps an ordinary
+# gitshelve, sharing its objects tree, books, value cache and stats, but
+# runs every Git command as an asyncio subprocess, so that reading and
+# committing never block the event loop.  Values are read through one
+# long-lived 'git cat-file --batch' process which pipelines the requests of
+# all waiting coroutines; the blobs and trees of a commit are written
+# concurrently, at most max_processes Git processes at a time.
+#
+# Example:
+#
+#   import gitshelve_async
+#
+#   async def main():
+#       data = await gitshelve_async.open(branch='mydata',
+#                                         repository='/tmp/foo')
+#       await data.set('foo/bar/git.c', "This is some sample data.")
+#       await data.commit("Changes")
+#       print(await data.get('foo/bar/git.c'))
+#       async for path in data:
+#           print(path)
+#       await data.close()
+#
+# This module needs Python 3.6 or later; gitshelve itself does not.
+
+import asyncio
+import os
+import random
+import time
+from asyncio.subprocess import PIPE, DEVNULL
+from collections import deque
+
+import gitshelve
+from gitshelve import GitConflict, GitError, gitbook, gittree, record_git, \
+    to_unicode
+
+
+async def git(cmd, *args, **kwargs):
+    """Like gitshelve.git(), but runs Git as an asyncio subprocess."""
+    environ = gitshelve.git_environ(kwargs.get('repository'),
+                                    kwargs.get('worktree'))
+    input_str = kwargs.get('input')
+    if isinstance(input_str, str):
+        input_str = input_str.encode('utf-8')
+
+    start = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        'git', cmd, *args, env=environ,
+        stdin=PIPE if input_str is not None else None,
+        stdout=PIPE, stderr=PIPE)
+    out, err = await proc.communicate(input_str)
+
+    returncode = proc.returncode
+    record_git(kwargs.get('stats'), cmd, args, time.time() - start,
+               bytes_in=len(input_str or b''), bytes_out=len(out),
+               failed=returncode != 0)
+    if returncode != 0 and not kwargs.get('ignore_errors', False):
+        raise GitError(cmd, args, kwargs, err, returncode)
+
+    retval = to_unicode(out)
+    if 'keep_newline' not in kwargs:
+        retval = retval[:-1]
+    return retval
+
+
+class asyncreader(object):
+    """The asyncio counterpart of gitshelve.gitreader.  Any number of
+    coroutines may read at once: each request is written to the process as
+    soon as it is made, and a single task hands the replies, which arrive in
+    the same order, back to the coroutines waiting for them."""
+    def __init__(self, repository=None, stats=None):
+        self.repository = repository
+        self.stats = stats
+        self.proc = None
+        self.task = None
+        self.pending = None
+        self.spawns = 0
+        self.lock = None
+
+    async def ensure_started(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.proc is not None and self.proc.returncode is None:
+                return
+            await self.close()
+            self.spawns += 1
+            self.proc = await asyncio.create_subprocess_exec(
+                'git', 'cat-file', '--batch',
+                env=gitshelve.git_environ(self.repository),
+                stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            self.pending = deque()
+            self.task = asyncio.ensure_future(
+                self.receive(self.proc, self.pending))
+
+    async def receive(self, proc, pending):
+        try:
+            while True:
+                header = await proc.stdout.readline()
+                if not header:
+                    break
+                fields = header.split()
+                if len(fields) != 3:
+                    result = None
+                else:
+                    data = await proc.stdout.readexactly(int(fields[2]) + 1)
+                    result = (to_unicode(fields[1]), data[:-1])
+                future = pending.popleft()
+                if not future.done():
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, IndexError):
+            pass
+        finally:
+            while pending:
+                future = pending.popleft()
+                if not future.done():
+                    future.set_exception(GitError(
+                        'cat-file', ['--batch'], {},
+                        "reader died while reading objects"))
+
+    async def read(self, name):
+        """Return (type, data) for the object called NAME."""
+        start, spawns = time.time(), self.spawns
+        result = None
+        try:
+            await self.ensure_started()
+            future = asyncio.get_event_loop().create_future()
+            self.pending.append(future)
+            self.proc.stdin.write(name.encode('utf-8') + b'\n')
+            try:
+                await self.proc.stdin.drain()
+            except (ConnectionError, OSError):
+                pass  # the process died; receive() fails the future
+            result = await future
+        finally:
+            record_git(self.stats, 'cat-file', ('--batch',),
+                       time.time() - start, bytes_in=len(name) + 1,
+                       bytes_out=len(result[1]) if result else 0,
+                       failed=result is None, spawns=self.spawns - spawns)
+        if result is None:
+            raise GitError('cat-file', ['--batch'], {}, "%s missing" % name)
+        return result
+
+    async def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (ConnectionError, OSError):
+            pass
+        await proc.wait()
+        await self.task
+        self.task = None
+
+
+class asyncgitshelve(object):
+    """A gitshelve for asyncio programs.  The shelf itself is an ordinary
+    gitshelve, available as .shelf, whose objects tree and books this class
+    reads and writes with asyncio subprocesses instead of blocking ones.
+
+    Reads may run concurrently with each other and with a commit; changes
+    made while a commit is running wait for it to finish.  Commits always
+    build their trees with 'git mktree' (or in-process, with the 'python'
+    backend), whatever the commit_engine of the wrapped shelf.  They take
+    the branch lock if commit_lock is set, and replay the shelf's changes
+    onto a branch moved meanwhile as often as retries allows, just as
+    gitshelve.commit() does.
+
+    With any of the autocommit options, open() starts the shelf's
+    autocommit thread as gitshelve.open() does.  That thread holds the
+    shelf's mutex while it commits, running Git as it goes, so changes
+    made meanwhile take the mutex by polling it between short sleeps of at
+    most mutex_poll seconds rather than by blocking the event loop in
+    acquire(); wait_for_commit() and close() wait for the thread on
+    another thread of the loop's executor."""
+    batch_size = 256
+    mutex_poll = 0.01
+
+    def __init__(self, branch='master', repository=None, keep_history=True,
+                 book_type=gitbook, max_processes=8, **kwargs):
+        self.shelf = gitshelve.gitshelve(branch, repository, keep_history,
+                                         book_type, **kwargs)
+        self.max_processes = max_processes
+        self.reader = None
+        self.processes = None
+        self.writing = None
+        self.loading = {}
+
+    async def open(cls, branch='master', repository=None, keep_history=True,
+                   book_type=gitbook, **kwargs):
+        shelf = cls(branch, repository, keep_history, book_type, **kwargs)
+        await shelf.read_repository()
+        shelf.shelf.start_autocommit()
+        return shelf
+
+    open = classmethod(open)
+
+    def __repr__(self):
+        return '<gitshelve_async.asyncgitshelve %s>' % self.shelf.branch
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def get_locks(self):
+        # created on first use, inside the running event loop
+        if self.writing is None:
+            self.processes = asyncio.Semaphore(self.max_processes)
+            self.writing = asyncio.Lock()
+        return self.processes, self.writing
+
+    async def git(self, *args, **kwargs):
+        if self.shelf.repository:
+            kwargs['repository'] = self.shelf.repository
+        kwargs['stats'] = self.shelf.stats
+        async with self.get_locks()[0]:
+            return await git(*args, **kwargs)
+
+    async def ls_tree(self, *args):
+        """Yield lists of (mode, type, name, path) entries as 'git ls-tree
+        -z ARGS' lists them, a chunk of output at a time."""
+        shelf = self.shelf
+        start = time.time()
+        size = 0
+        async with self.get_locks()[0]:
+            proc = await asyncio.create_subprocess_exec(
+                'git', 'ls-tree', '-z', *args,
+                env=gitshelve.git_environ(shelf.repository),
+                stdout=PIPE, stderr=PIPE)
+            pending = b''
+            try:
+                while True:
+                    chunk = await proc.stdout.read(shelf.read_chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    entries = (pending + chunk).split(b'\0')
+                    pending = entries.pop()
+                    yield [gitshelve.parse_ls_tree_entry(entry)
+                           for entry in entries]
+                if pending:
+                    yield [gitshelve.parse_ls_tree_entry(pending)]
+            finally:
+                if proc.returncode is None and not proc.stdout.at_eof():
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+                err = await proc.stderr.read()
+                returncode = await proc.wait()
+                record_git(shelf.stats, 'ls-tree', args, time.time() - start,
+                           bytes_out=size, failed=returncode != 0)
+        if returncode != 0:
+            raise GitError('ls-tree', args, {}, err, returncode)
+
+    async def read_repository(self):
+        shelf = self.shelf
+        shelf.init_data()
+        shelf.head_read = True
+        try:
+            shelf.head = await self.git('rev-parse', shelf.branch)
+        except GitError:
+            return
+        if shelf.compact:
+            index = gitshelve.gitindex()
+            async for entries in self.ls_tree('--full-tree', '-r', '-t',
+                                              shelf.head):
+                for mode, kind, name, path in entries:
+                    if kind != 'tree':
+                        shelf.check_mode(mode, path)
+                    index.append(path, kind, name)
+            index.finish()
+            shelf.fill_from_index(index, shelf.objects)
+        else:
+            await self.list_tree(shelf.head, shelf.objects,
+                                 recursive=not shelf.lazy)
+
+    async def list_tree(self, treeish, objects, path='', recursive=True):
+        if recursive:
+            args = ('--full-tree', '-r', '-t', treeish)
+        else:
+            args = (treeish,)
+        dirs = None
+        async for entries in self.ls_tree(*args):
+            dirs = self.shelf.fill_tree(entries, objects, path, recursive,
+                                        dirs)
+
+    async def load_tree(self, tree):
+        """Fill in TREE if it is a gittree that hasn't been read yet.
+        Coroutines asking for the same tree share a single listing."""
+        task = self.loading.get(id(tree))
+        if task is None:
+            if not isinstance(tree, gittree) or tree.loaded:
+                return
+            tree.loaded = True
+            if tree.index is not None:
+                self.shelf.fill_from_index(tree.index, tree, tree.path)
+                return
+            task = asyncio.ensure_future(
+                self.list_tree(tree['__root__'], tree, tree.path, False))
+            self.loading[id(tree)] = task
+            task.add_done_callback(
+                lambda task: self.loading.pop(id(tree), None))
+        await task
+
+    async def get_tree(self, path, make_dirs=False):
+        """Like gitshelve.get_tree(), reading any unread trees on the way
+        first.  Raises KeyError if PATH doesn't exist."""
+        d = self.shelf.objects
+        for part in path.split(os.sep):
+            await self.load_tree(d)
+            if make_dirs and part not in d:
+                d[part] = {}
+            d = d[part]
+        await self.load_tree(d)
+        return d
+
+    async def load_book(self, book):
+        """Read the data of BOOK, unless it is already in memory."""
+        if book.data is not None or book.name is None:
+            return
+        shelf = self.shelf
+        result = None
+        objectdb = shelf.get_objectdb()
+        if objectdb is not None:
+            result = objectdb.read(book.name)
+        if result is None:
+            if self.reader is None:
+                self.reader = asyncreader(shelf.repository, shelf.stats)
+            result = await self.reader.read(book.name)
+        kind, data = result
+        if kind != 'blob':
+            raise GitError('cat-file', ['blob', book.name], {},
+                           'expected blob, found %s' % kind, 128)
+        if book.data is None:
+            book.data = book.deserialize_data(to_unicode(data))
+            if shelf.cache is not None:
+                shelf.cache.add(book, len(data))
+
+    async def get_book(self, path):
+        try:
+            d = await self.get_tree(path)
+        except KeyError:
+            raise KeyError(path)
+        if '__book__' not in d:
+            raise KeyError(path)
+        return d['__book__']
+
+    async def get(self, path):
+        """Return the value stored at PATH."""
+        book = await self.get_book(path)
+        await self.load_book(book)
+        return book.get_data()
+
+    async def get_many(self, paths):
+        """Return a dict mapping each of PATHS to its value, reading all of
+        them concurrently."""
+        values = await asyncio.gather(*[self.get(path) for path in paths])
+        return dict(zip(paths, values))
+
+    async def contains(self, path):
+        try:
+            d = await self.get_tree(path)
+        except KeyError:
+            return False
+        return len(d) == 1 and '__book__' in d
+
+    async def lock_shelf(self):
+        """Take the shelf's mutex without blocking the event loop while its
+        autocommit thread holds it.  The caller releases it.  Coroutines
+        share the loop's thread, and so the mutex; they are kept apart by
+        the writing lock instead."""
+        mutex = self.shelf.mutex
+        delay = min(0.001, self.mutex_poll)
+        while not mutex.acquire(False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.mutex_poll)
+
+    async def set(self, path, data):
+        async with self.get_locks()[1]:
+            await self.load_parents(path)
+            await self.lock_shelf()
+            try:
+                self.shelf[path] = data
+            finally:
+                self.shelf.mutex.release()
+
+    async def delete(self, path):
+        async with self.get_locks()[1]:
+            await self.load_parents(path)
+            await self.lock_shelf()
+            try:
+                del self.shelf[path]
+            finally:
+                self.shelf.mutex.release()
+
+    async def load_parents(self, path):
+        """Read the unread trees leading to PATH, so that changing it doesn't
+        make the shelf list them while blocking the event loop."""
+        d = self.shelf.objects
+        for part in path.split(os.sep):
+            await self.load_tree(d)
+            d = d.get(part)
+            if not isinstance(d, dict):
+                break
+        else:
+            await self.load_tree(d)
+
+    async def put(self, data):
+        """Store DATA under a path made from its blob name, as
+        gitshelve.put() does, and return the name."""
+        shelf = self.shelf
+        book = shelf.book_type(shelf, '__unknown__')
+        book.data = data
+        blob = book.serialize_data(book.data)
+        book.name = await self.make_blob(blob)
+        async with self.get_locks()[1]:
+            await self.load_parents('%s/%s' % (book.name[:2], book.name[2:]))
+            await self.lock_shelf()
+            try:
+                return shelf.store_book(book, blob)
+            finally:
+                shelf.mutex.release()
+
+    async def make_blob(self, data):
+        objectdb = self.shelf.get_objectdb()
+        if objectdb is not None:
+            return objectdb.write('blob', gitshelve.to_bytes(data))
+        return await self.git('hash-object', '-w', '--stdin', input=data)
+
+    async def write_tree(self, entries):
+        objectdb = self.shelf.get_objectdb()
+        if objectdb is not None:
+            return objectdb.write('tree', gitshelve.encode_tree(entries))
+        return await self.git('mktree', '-z', input=''.join(
+            "%s %s %s\t%s\0" % entry for entry in entries))
+
+    async def make_entry(self, obj, path):
+        """Return the tree entry for OBJ, writing it first if it's a dirty
+        book or a changed directory."""
+        if '__book__' in obj and len(obj) == 1:
+            book = obj['__book__']
+            blob = book.serialize_data(book.data)
+            book.name = await self.make_blob(blob)
+            book.dirty = False
+            self.shelf.remember(book, blob)
+            return ('100644', 'blob', book.name, path)
+        return ('040000', 'tree', await self.make_tree(obj), path)
+
+    async def make_tree(self, objects):
+        """The asyncio counterpart of gitshelve.make_tree(): the dirty books
+        and changed subtrees of OBJECTS are all written concurrently."""
+        root = objects.get('__root__')
+        entries = []
+        changed = []
+        for path in list(objects.keys()):
+            if path == '__root__':
+                continue
+            obj = objects[path]
+            if not isinstance(obj, dict):
+                raise TypeError("objects['%s'] is not a dict" % path)
+            if '__root__' in obj:
+                entries.append(('040000', 'tree', obj['__root__'], path))
+            elif len(obj) == 1 and '__book__' in obj and \
+                    not obj['__book__'].dirty:
+                entries.append(('100644', 'blob', obj['__book__'].name,
+                                path))
+            else:
+                changed.append(self.make_entry(obj, path))
+        if changed:
+            entries.extend(await asyncio.gather(*changed))
+            root = None
+
+        if root is None:
+            root = objects['__root__'] = await self.write_tree(entries)
+        return root
+
+    async def commit(self, comment=None):
+        shelf = self.shelf
+        async with self.get_locks()[1]:
+            # keep the shelf's autocommit thread out until we're done
+            await self.lock_shelf()
+            try:
+                if not shelf.dirty:
+                    return shelf.head
+                # the lock is waited for, and found the first time, on
+                # another thread, so that the event loop goes on meanwhile
+                loop = asyncio.get_event_loop()
+                lock = await loop.run_in_executor(None,
+                                                  shelf.get_branch_lock)
+                if lock is None:
+                    return await self.commit_changes(comment)
+                await loop.run_in_executor(None, lock.acquire)
+                try:
+                    await self.rebase()
+                    return await self.commit_changes(comment)
+                finally:
+                    lock.release()
+            finally:
+                shelf.mutex.release()
+
+    async def commit_changes(self, comment):
+        shelf = self.shelf
+        attempt = 0
+        while True:
+            try:
+                name = await self.commit_objects(comment)
+                break
+            except GitConflict:
+                raise
+            except GitError as e:
+                if e.cmd != 'update-ref' or attempt >= shelf.retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, shelf.retry_backoff *
+                                               (1 << (attempt - 1))))
+            await self.rebase()
+
+        shelf.finish_commit()
+        return name
+
+    async def commit_objects(self, comment):
+        shelf = self.shelf
+        tree = await self.make_tree(shelf.objects)
+        if shelf.head and shelf.keep_history:
+            name = await self.git('commit-tree', tree, '-p', shelf.head,
+                                  input=comment or '')
+        else:
+            name = await self.git('commit-tree', tree, input=comment or '')
+        ref = 'refs/heads/%s' % shelf.branch
+        old = shelf.head
+        if old is None and shelf.head_read:
+            old = '0' * len(name)  # the branch must not exist yet
+        if old is not None:
+            await self.git('update-ref', ref, name, old)
+        else:
+            await self.git('update-ref', ref, name)
+        shelf.head = name
+        return name
+
+    async def rebase(self):
+        """The asyncio counterpart of gitshelve.rebase()."""
+        shelf = self.shelf
+        try:
+            head = await self.git('rev-parse', shelf.branch)
+        except GitError:
+            head = None
+        if head == shelf.head:
+            return []
+        return shelf.replay(await self.diff_tree(shelf.rebase_base(head),
+                                                 head), head)
+
+    async def diff_tree(self, old, new):
+        """Return the list of entries gitshelve.diff_tree() would yield."""
+        out = await self.git('diff-tree', '-r', '-t', '-z', old, new,
+                             keep_newline=True)
+        fields = out.split('\0')
+        entries = []
+        for i in range(0, len(fields) - 1, 2):
+            # ':old_mode new_mode old_name new_name status', then the path
+            meta = fields[i][1:].split()
+            entries.append((meta[0], meta[1], meta[3], fields[i + 1]))
+        return entries
+
+    async def wait_for_commit(self, sequence=None, timeout=None):
+        """The asyncio counterpart of gitshelve.wait_for_commit()."""
+        shelf = self.shelf
+        if sequence is None:
+            sequence = shelf.sequence
+        if shelf.autocommitter is None:
+            if shelf.committed_sequence < sequence:
+                await self.commit()
+            return True
+        return await asyncio.get_event_loop().run_in_executor(
+            None, shelf.wait_for_commit, sequence, timeout)
+
+    async def close(self):
+        # the thread may be in the middle of a commit, which is waited for
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.shelf.stop_autocommit)
+        if self.shelf.dirty:
+            await self.commit()
+        if self.reader is not None:
+            await self.reader.close()
+            self.reader = None
+        self.shelf.close()
+
+    async def walk(self, objects, path=''):
+        await self.load_tree(objects)
+        for part, obj in list(objects.items()):
+            if part == '__root__':
+                continue
+            key = path and os.sep.join((path, part)) or part
+            if not isinstance(obj, gittree) and len(obj) == 1 and \
+                    '__book__' in obj:
+                yield key, obj['__book__']
+            else:
+                async for item in self.walk(obj, key):
+                    yield item
+
+    def __aiter__(self):
+        return self.keys()
+
+    async def keys(self):
+        async for key, book in self.walk(self.shelf.objects):
+            yield key
+
+    async def items(self):
+        """Yield (path, value) for every value, reading them from Git
+        batch_size at a time."""
+        batch = []
+        async for item in self.walk(self.shelf.objects):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                async for item in self.load_batch(batch):
+                    yield item
+                batch = []
+        async for item in self.load_batch(batch):
+            yield item
+
+    async def values(self):
+        async for key, value in self.items():
+            yield value
+
+    async def load_batch(self, batch):
+        await asyncio.gather(*[self.load_book(book) for key, book in batch])
+        for key, book in batch:
+            yield key, book.get_data()
+
+
+async def open(branch='master', repository=None, keep_history=True,
+               book_type=gitbook, **kwargs):
+    return await asyncgitshelve.open(branch, repository, keep_history,
+                                     book_type, **kwargs)
+
+# gitshelve_async.py ends here
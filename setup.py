@@ -4,8 +4,13 @@ from __future__ import print_function
 from gitshelve import GITSHELVE_VERSION
 
 import os.path
+import sys
 from setuptools import setup
 
+py_modules = ['gitshelve']
+if sys.version_info >= (3, 6):
+    py_modules.append('gitshelve_async')
+
 
 def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
@@ -18,7 +23,7 @@ setup(name='gitshelve',
       description='Python object for easily writing scripts that store arbitrary data inside a Git repository.',
       long_description=read('README.md'),
       url='https://github.com/tstone2077/gitshelve',
-      py_modules=['gitshelve'],
+      py_modules=py_modules,
       script_name = 'setup.py',
       test_suite="test",
       classifiers=[
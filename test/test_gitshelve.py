@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import inspect
 import os
+import random
 import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 try:
     import unittest2 as unittest
 except ImportError:
@@ -235,6 +239,198 @@ class TestGitShelve(unittest.TestCase):
         # TODO: some verification that the repo was read
         s.close()
 
+    def testGitshelveReadRepositoryStreaming(self):
+        s = gitshelve.open('test')
+        paths = ['a/b/c', 'a/b/d', 'a/e', u'\u00e9t\u00e9/caf\u00e9', 'z']
+        for path in paths:
+            s[path] = path
+        s.commit()
+        expected = StringIO()
+        gitshelve.open('test').dump_objects(expected)
+
+        # chunk boundaries fall inside entries, and inside UTF-8 sequences
+        for chunk_size in (1, 7, 53, 65536):
+            s = gitshelve.gitshelve('test')
+            s.read_chunk_size = chunk_size
+            s.read_repository()
+            buf = StringIO()
+            s.dump_objects(buf)
+            self.assertEqual(expected.getvalue(), buf.getvalue())
+            self.assertEqual(sorted(paths), sorted(s.keys()))
+            self.assertEqual('a/b/c', s['a/b/c'])
+            s.close()
+
+        # anything but regular files can't be read into a shelf
+        blob = gitshelve.git('rev-parse', 'test:z')
+        tree = gitshelve.git('mktree', input='100755 blob %s\tx\n' % blob)
+        commit = gitshelve.git('commit-tree', tree, input='exec')
+        gitshelve.git('update-ref', 'refs/heads/exec', commit)
+        with self.assertRaises(gitshelve.GitError):
+            gitshelve.open('exec')
+
+    def testGitshelveLazy(self):
+        s = gitshelve.open('test')
+        for top in ('a', 'b', 'c'):
+            for sub in ('x', 'y'):
+                s['%s/%s/key' % (top, sub)] = top + sub
+        s['top'] = 'top'
+        s.commit()
+        tree = gitshelve.git('rev-parse', 'test^{tree}')
+        s.close()
+
+        s = gitshelve.open('test', lazy=True)
+        self.assertEqual(['a', 'b', 'c', 'top'], sorted(s.objects.keys()))
+        for top in ('a', 'b', 'c'):
+            self.assertFalse(dict.__getitem__(s.objects, top).loaded)
+
+        # reading a key lists only the trees on its path
+        self.assertEqual('bx', s['b/x/key'])
+        b = dict.__getitem__(s.objects, 'b')
+        self.assertTrue(b.loaded)
+        self.assertTrue(dict.__getitem__(b, 'x').loaded)
+        self.assertFalse(dict.__getitem__(b, 'y').loaded)
+        self.assertFalse(dict.__getitem__(s.objects, 'a').loaded)
+        self.assertEqual('top', s['top'])
+
+        # committing a change leaves the untouched trees unread
+        s['c/y/key'] = 'changed'
+        s.commit()
+        self.assertFalse(dict.__getitem__(s.objects, 'a').loaded)
+        self.assertFalse(dict.__getitem__(b, 'y').loaded)
+        s['c/y/key'] = 'cy'
+        s.commit()
+        self.assertEqual(tree, gitshelve.git('rev-parse', 'test^{tree}'))
+
+        del s['a/x']
+        s.commit()
+        self.assertEqual('', gitshelve.git('ls-tree', 'test', 'a/x'))
+
+        expected = sorted(gitshelve.open('test').keys())
+        self.assertEqual(expected, sorted(s.keys()))
+        s.close()
+
+    def testGitshelveCompact(self):
+        s = gitshelve.open('test')
+        paths = ['x/y', 'x-y', 'x.c', 'x/z/w', 'x0', 'a/b/c/d', 'top']
+        for path in paths:
+            s[path] = path
+        s.commit()
+        tree = gitshelve.git('rev-parse', 'test^{tree}')
+        s.close()
+
+        s = gitshelve.open('test', compact=True)
+        # seven blobs and five trees
+        self.assertEqual(12, len(dict.__getitem__(s.objects, 'x').index))
+        self.assertEqual(['a', 'top', 'x', 'x-y', 'x.c', 'x0'],
+                         sorted(s.objects.keys()))
+        # keys come from the index without reading any trees
+        self.assertEqual(sorted(paths), sorted(s.keys()))
+        x = dict.__getitem__(s.objects, 'x')
+        self.assertFalse(x.loaded)
+        self.assertEqual(['__root__', 'y', 'z'], sorted(x.keys()))
+        self.assertFalse(dict.__getitem__(x, 'z').loaded)
+        self.assertEqual('x/z/w', s['x/z/w'])
+        self.assertEqual('a/b/c/d', s['a/b/c/d'])
+        self.assertEqual(sorted(paths), sorted(s.keys()))
+
+        s['x/z/w'] = 'changed'
+        del s['x0']
+        s.commit()
+        s['x/z/w'] = 'x/z/w'
+        s['x0'] = 'x0'
+        s.commit()
+        self.assertEqual(tree, gitshelve.git('rev-parse', 'test^{tree}'))
+
+        book = s.get_tree('top')['__book__']
+        self.assertFalse(hasattr(book, '__dict__'))
+        s.close()
+
+        # names come back from Git as unicode, which Python 2's intern()
+        # refuses; they are then kept as they are
+        self.assertEqual(u'x/z', gitshelve.intern(u'x/z'))
+        self.assertEqual('x/z', gitshelve.intern('x/z'))
+
+    def testGitshelveCache(self):
+        s = gitshelve.open('test')
+        for i in range(5):
+            s['k/%d' % i] = 'value %d' % i
+        s.commit()
+        s.close()
+
+        s = gitshelve.open('test', cache_entries=2)
+        for i in range(5):
+            self.assertEqual('value %d' % i, s['k/%d' % i])
+        self.assertEqual({'entries': 2, 'bytes': 14, 'hits': 0,
+                          'misses': 5, 'evictions': 3}, s.cache_stats())
+        self.assertEqual(None, s.get_tree('k/0')['__book__'].data)
+        self.assertEqual('value 4', s.get_tree('k/4')['__book__'].data)
+
+        # changed books stay loaded until they are committed
+        s['k/0'] = 'changed 0'
+        s['k/1'] = 'changed 1'
+        s['k/2'] = 'changed 2'
+        self.assertEqual('value 3', s['k/3'])
+        self.assertEqual('value 4', s['k/4'])
+        self.assertEqual('changed 0', s.get_tree('k/0')['__book__'].data)
+        s.commit()
+        self.assertEqual(2, s.cache_stats()['entries'])
+        self.assertEqual('changed 0', s['k/0'])
+        self.assertEqual('value 4', s['k/4'])
+        s.close()
+
+        s = gitshelve.open('test', cache_bytes=20)
+        for i in range(5):
+            s['k/%d' % i]
+        self.assertTrue(s.cache_stats()['bytes'] <= 20)
+        self.assertEqual(2, s.cache_stats()['entries'])
+        self.assertEqual(['changed 0', 'changed 1', 'changed 2',
+                          'value 3', 'value 4'],
+                         [s['k/%d' % i] for i in range(5)])
+        s.close()
+
+    def testGitshelveStats(self):
+        s = gitshelve.open('test')
+        s['a/b'] = 'data'
+        s.commit()
+        s.close()
+
+        slow = []
+        s = gitshelve.open('test')
+        s.stats.add_hook(lambda cmd, args, elapsed: slow.append(cmd))
+        s.stats.reset()
+        self.assertEqual('data', s['a/b'])
+        s['a/c'] = 'more data'
+        s.commit()
+        with self.assertRaises(gitshelve.GitError):
+            s.git('rev-parse', 'no-such-branch')
+        summary = s.stats.summary()
+        self.assertEqual(['cat-file', 'commit-tree', 'hash-object', 'mktree',
+                          'rev-parse', 'update-ref'], sorted(summary))
+        self.assertEqual(1, summary['cat-file']['spawns'])
+        self.assertEqual(len('data'), summary['cat-file']['bytes_out'])
+        self.assertEqual(len('more data'), summary['hash-object']['bytes_in'])
+        self.assertEqual(1, summary['rev-parse']['failures'])
+        self.assertEqual(2, summary['mktree']['count'])
+        self.assertEqual(7, s.stats.spawns())
+        self.assertEqual(7, len(slow))
+        self.assertTrue(summary['mktree']['max'] >= summary['mktree']['p50'])
+
+        s.stats.add_hook(lambda cmd, args, elapsed: slow.append(cmd), 60)
+        s['a/c'] = 'changed'
+        s.commit()
+        self.assertEqual(12, len(slow))
+        s.close()
+
+        s = gitshelve.open('test', commit_engine='fast-import')
+        s['a/c'] = 'imported'
+        s.commit()
+        summary = s.stats.summary()
+        self.assertEqual(1, summary['fast-import']['spawns'])
+        self.assertTrue(summary['fast-import']['bytes_in'] > 0)
+        self.assertTrue(gitshelve.default_stats.summary()['fast-import']
+                        ['count'] >= 1)
+        s.close()
+
     def testGitshelveHashBlob(self):
         data = 'this is some data'
         s = gitshelve.gitshelve()
@@ -249,6 +445,211 @@ class TestGitShelve(unittest.TestCase):
                          s.make_blob(data))
         s.close()
 
+    def testGitshelvePythonBackend(self):
+        data = 'this is some data'
+        s = gitshelve.gitshelve(backend='python')
+        self.assertEqual('82fa9daba4cab515726fff892362b942dc01d625',
+                         s.hash_blob(data))
+        self.assertEqual('82fa9daba4cab515726fff892362b942dc01d625',
+                         s.make_blob(data))
+        self.assertEqual(data, gitshelve.git(
+            'cat-file', 'blob', '82fa9daba4cab515726fff892362b942dc01d625',
+            keep_newline=True))
+        self.assertEqual('', gitshelve.git('fsck', '--no-dangling'))
+        # writing an object that already exists is a no-op
+        self.assertEqual('82fa9daba4cab515726fff892362b942dc01d625',
+                         s.make_blob(data))
+        s['foo/bar'] = data
+        s.commit()
+        self.assertEqual(data, gitshelve.git('cat-file', 'blob',
+                                             'master:foo/bar',
+                                             keep_newline=True))
+        s.close()
+        with self.assertRaises(ValueError):
+            gitshelve.gitshelve(backend='nothing')
+
+        # repositories using SHA-256 fall back to running Git
+        repo = os.path.join(self.gitDir, 'sha256')
+        gitshelve.git('init', '--bare', '--object-format=sha256', repo)
+        s = gitshelve.gitshelve(repository=repo, backend='python')
+        self.assertEqual(None, s.get_objectdb())
+        self.assertEqual(64, len(s.make_blob(data)))
+        self.assertEqual(64, len(s.hash_blob(data)))
+        s.close()
+
+    def testGitshelvePythonBackendTrees(self):
+        text = "Hello, this is a test\n"
+        shelves = {}
+        for backend in ('git', 'python'):
+            shelf = gitshelve.open(backend, backend=backend)
+            # names chosen so that sorting subtrees as 'name/' matters
+            shelf['foo/bar/baz.c'] = text
+            shelf['foo/bar.c'] = text
+            shelf['foo/bar-x'] = text
+            shelf['foo/bar0'] = text
+            shelf['foo.c'] = text
+            shelf['foo0/x'] = text
+            shelf[u'\u00e9t\u00e9/caf\u00e9'] = text
+            shelf.commit('trees')
+            buf = StringIO()
+            shelf.dump_objects(buf)
+            shelves[backend] = buf.getvalue()
+            shelf.close()
+        self.assertEqual(shelves['git'], shelves['python'])
+        self.assertEqual(gitshelve.git('rev-parse', 'git^{tree}'),
+                         gitshelve.git('rev-parse', 'python^{tree}'))
+        self.assertEqual('', gitshelve.git('fsck', '--no-dangling'))
+
+    def testGitshelvePythonBackendRead(self):
+        shelf = gitshelve.open('test')
+        lines = ['line %d of a long value\n' % i for i in range(500)]
+        values = []
+        for i in range(10):
+            # every version differs slightly, so repacking makes deltas
+            lines[i * 37] = 'changed in version %d\n' % i
+            values.append(''.join(lines))
+            shelf['versions/%d' % i] = values[-1]
+            shelf['latest'] = values[-1]
+            shelf.commit('version %d' % i)
+        shelf.close()
+        gitshelve.git('repack', '-a', '-d', '-f', '--depth=50',
+                      '--window=50')
+        gitshelve.git('prune')
+        shelf = gitshelve.open('test', backend='python')
+        shelf['loose'] = 'a loose object'  # written loose
+        shelf.commit()
+        loose = shelf.get_tree('loose')['__book__'].name
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.gitDir, '.git', 'objects', loose[:2], loose[2:])))
+
+        for i in range(10):
+            self.assertEqual(values[i], shelf['versions/%d' % i])
+        self.assertEqual(values[-1], shelf['latest'])
+        self.assertEqual('a loose object', shelf['loose'])
+        self.assertEqual(None, shelf.reader)
+        objectdb = shelf.get_objectdb()
+        self.assertEqual(1, len(objectdb.packs))
+        kind, data = objectdb.read(gitshelve.git('rev-parse', 'test'))
+        self.assertEqual('commit', kind)
+
+        # objects the pack reader can't find are left to cat-file
+        self.assertEqual(None, objectdb.read('0' * 40))
+        with self.assertRaises(gitshelve.GitError):
+            shelf.get_blob('0' * 40)
+
+        # packs written after the shelf was opened are picked up
+        shelf['new'] = 'packed later'
+        shelf.commit()
+        gitshelve.git('repack', '-d')
+        gitshelve.git('prune-packed')
+        self.assertEqual(1, len(objectdb.packs))
+        book = shelf.get_tree('new')['__book__']
+        book.data = None
+        self.assertEqual('packed later', shelf['new'])
+        self.assertEqual(2, len(objectdb.packs))
+
+        # and the packs a repack replaces are unmapped
+        old = list(objectdb.packs)
+        shelf['newer'] = 'packed last'
+        shelf.commit()
+        gitshelve.git('repack', '-a', '-d')
+        gitshelve.git('prune-packed')
+        book = shelf.get_tree('newer')['__book__']
+        book.data = None
+        self.assertEqual('packed last', shelf['newer'])
+        self.assertEqual(1, len(objectdb.packs))
+        for pack in old:
+            with self.assertRaises(ValueError):
+                pack.pack[:1]
+        shelf.close()
+
+    def testGitshelvePythonBackendDeepDeltas(self):
+        # Each commit replaces one random chunk of the same value, so that
+        # its closest relative is the version before and repacking makes
+        # delta chains over a hundred entries deep.
+        rng = random.Random(0)
+        chunks = ['%x' % rng.getrandbits(2048) for i in range(200)]
+        values = []
+        shelf = gitshelve.open('test')
+        for i in range(150):
+            chunks[rng.randrange(200)] = '%x' % rng.getrandbits(2048)
+            values.append('\n'.join(chunks))
+            shelf['value'] = values[-1]
+            shelf.commit()
+        shelf.close()
+        names = [gitshelve.hash_object('blob', gitshelve.to_bytes(value))
+                 for value in values]
+        gitshelve.git('repack', '-a', '-d', '-f', '--depth=1000',
+                      '--window=10')
+        gitshelve.git('prune')
+
+        shelf = gitshelve.open('test', backend='python')
+        objectdb = shelf.get_objectdb()
+        objectdb.read(names[-1])
+        # keep no delta bases, so that every read walks its whole chain
+        objectdb.cache_size = 0
+        # leave less stack than the delta chains are deep
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(inspect.stack()) + 60)
+        try:
+            read = [objectdb.read(name) for name in names]
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(values, [gitshelve.to_unicode(data)
+                                  for kind, data in read])
+        shelf.close()
+
+    def testGitshelveGetBlob(self):
+        data = 'this is some data'
+        s = gitshelve.gitshelve()
+        name = s.make_blob(data)
+        self.assertEqual(data, s.get_blob(name))
+        # every read goes through the same cat-file process
+        pid = s.reader.proc.pid
+        self.assertEqual(data, s.get_blob(name))
+        self.assertEqual(pid, s.reader.proc.pid)
+        with self.assertRaises(gitshelve.GitError):
+            s.get_blob('0' * 40)
+        tree = gitshelve.git('write-tree')
+        with self.assertRaises(gitshelve.GitError):
+            s.get_blob(tree)
+        # a reader that died is restarted transparently
+        s.reader.proc.kill()
+        s.reader.proc.wait()
+        self.assertEqual(data, s.get_blob(name))
+        self.assertNotEqual(pid, s.reader.proc.pid)
+        s.close()
+        self.assertEqual(None, s.reader)
+
+    def testGitshelveGetManyAndPrefetch(self):
+        shelf = gitshelve.open('test')
+        for i in range(200):
+            shelf['dir%d/key%d' % (i % 3, i)] = 'value %d\n' % i * 100
+        shelf.commit('values')
+        shelf.close()
+
+        shelf = gitshelve.open('test')
+        paths = ['dir%d/key%d' % (i % 3, i) for i in range(0, 200, 7)]
+        values = shelf.get_many(paths)
+        self.assertEqual(len(paths), len(values))
+        for path in paths:
+            i = int(path.split('key')[1])
+            self.assertEqual('value %d\n' % i * 100, values[path])
+        with self.assertRaises(KeyError):
+            shelf.get_many(['dir0/nothere'])
+
+        self.assertEqual(0, shelf.prefetch(paths))
+        # dir1 holds 67 keys, 10 of which were loaded by get_many
+        self.assertEqual(57, shelf.prefetch('dir1'))
+        self.assertEqual(1, shelf.prefetch('dir2/key2'))
+        self.assertEqual(200 - len(paths) - 58, shelf.prefetch())
+        self.assertEqual(0, shelf.prefetch())
+        for book in shelf.values():
+            self.assertNotEqual(None, book.data)
+        with self.assertRaises(KeyError):
+            shelf.prefetch('nothere')
+        shelf.close()
+
     def testGitshelveMakeTree(self):
         # TODO:This test is very clumsy. Work can be done to build a meaningful
         # tree
@@ -298,6 +699,663 @@ class TestGitShelve(unittest.TestCase):
         s.sync()
         s.close()
 
+    def testGitshelveIncrementalCommit(self):
+        s = gitshelve.open('test')
+        for top in ('a', 'b', 'c'):
+            for sub in ('x', 'y'):
+                s['%s/%s/key' % (top, sub)] = top + sub
+        s['top'] = 'top'
+        s.commit()
+
+        written = []
+        write_tree = s.write_tree
+
+        def counting_write_tree(entries):
+            written.append(sorted(entry[3] for entry in entries))
+            return write_tree(entries)
+        s.write_tree = counting_write_tree
+
+        # only the changed key's ancestors are rebuilt
+        s['b/y/key'] = 'changed'
+        s.commit()
+        self.assertEqual([['key'], ['x', 'y'], ['a', 'b', 'c', 'top']],
+                         written)
+
+        del written[:]
+        s['b/y/other'] = 'new'
+        del s['c/x/key']
+        s.commit()
+        self.assertEqual(4, len(written))
+
+        # deleting a top-level key must still change the tree
+        del written[:]
+        del s['top']
+        s.commit()
+        self.assertEqual([['a', 'b', 'c']], written)
+        self.assertEqual('', gitshelve.git('ls-tree', 'test', 'top'))
+
+        del written[:]
+        s.put('blob')
+        s.commit()
+        self.assertEqual(2, len(written))
+
+        # a reopened shelf reuses the names listed by ls-tree
+        s = gitshelve.open('test')
+        tree = gitshelve.git('rev-parse', 'test^{tree}')
+        s.write_tree = counting_write_tree
+        s['a/x/key'] = 'changed'
+        s.commit()
+        del written[:]
+        s['a/x/key'] = 'ax'
+        s.commit()
+        self.assertEqual(3, len(written))
+        self.assertEqual(tree, gitshelve.git('rev-parse', 'test^{tree}'))
+        s.close()
+
+    def testGitshelveParallelCommit(self):
+        trees = []
+        for branch, options in (('serial', {}),
+                                ('threads', {'workers': 4}),
+                                ('python', {'workers': 4,
+                                            'backend': 'python'})):
+            s = gitshelve.open(branch, **options)
+            for i in range(40):
+                s['%d/%d' % (i % 5, i)] = 'value %d' % i
+            s.commit()
+            self.assertEqual([], s.dirty_books(s.objects))
+            self.assertEqual([], s.dirty_trees(s.objects))
+            s['1/6'] = 'changed'
+            s['new'] = 'new'
+            s['2/x/y/z'] = 'deep'
+            self.assertEqual(['changed', 'deep', 'new'],
+                             sorted(book.data for book in
+                                    s.dirty_books(s.objects)))
+            self.assertEqual([1, 2, 1, 1],
+                             [len(level) for level in
+                              s.dirty_trees(s.objects)])
+            s.commit()
+            self.assertEqual([], s.dirty_trees(s.objects))
+            trees.append(gitshelve.git('rev-parse', branch + '^{tree}'))
+            self.assertEqual(43, s.stats.summary()
+                             .get('hash-object', {'count': 43})['count'])
+            self.assertEqual(11, s.stats.summary()
+                             .get('mktree', {'count': 11})['count'])
+            s.close()
+        self.assertEqual(1, len(set(trees)))
+        self.assertEqual('changed', gitshelve.open('threads')['1/6'])
+
+    def testGitshelveParallelObjectdb(self):
+        # the workers must share one object database, not each race to
+        # create their own
+        located = []
+        locate = gitshelve.gitobjectdb.__dict__['locate']
+
+        def slow_locate(cls, repository=None, stats=None):
+            located.append(repository)
+            time.sleep(0.05)
+            return locate.__func__(cls, repository, stats)
+        gitshelve.gitobjectdb.locate = classmethod(slow_locate)
+        try:
+            s = gitshelve.open('test', workers=4, backend='python')
+            for i in range(8):
+                s['%d/%d' % (i % 4, i)] = 'value %d' % i
+            s.commit()
+        finally:
+            gitshelve.gitobjectdb.locate = locate
+        self.assertEqual(1, len(located))
+        self.assertEqual('value 5', gitshelve.open('test')['1/5'])
+        s.close()
+
+    def testGitshelveDeferredPut(self):
+        for tag, options in (('a', {}), ('b', {'backend': 'python'}),
+                             ('c', {'commit_engine': 'fast-import'})):
+            s = gitshelve.open('test', defer_writes=True, cache_entries=1,
+                               **options)
+            names = [s.put('blob %s%d' % (tag, i)) for i in range(3)]
+            self.assertEqual(gitshelve.hash_object(
+                'blob', gitshelve.to_bytes('blob %s0' % tag)), names[0])
+            self.assertEqual(
+                '', gitshelve.git('cat-file', '-t', names[0],
+                                  ignore_errors=True))
+            self.assertEqual(['blob %s%d' % (tag, i) for i in range(3)],
+                             [s.get(name) for name in names])
+            s.commit()
+            self.assertEqual('blob', gitshelve.git('cat-file', '-t',
+                                                   names[2]))
+            self.assertEqual([], s.pending)
+            self.assertFalse('hash-object' in s.stats.summary())
+            if not options:
+                self.assertEqual(1, s.stats.summary()['fast-import']['count'])
+            s.close()
+            self.assertEqual('blob %s1' % tag,
+                             gitshelve.open('test').get(names[1]))
+
+        s = gitshelve.open('test', defer_writes=True, max_pending_bytes=12)
+        name = s.put('deferred')
+        self.assertEqual(1, len(s.pending))
+        s.put('flushed now')
+        self.assertEqual([], s.pending)
+        self.assertEqual('deferred', gitshelve.git('cat-file', 'blob', name,
+                                                   keep_newline=True))
+        s.close()
+
+    def testGitshelveDeferredPutSha256(self):
+        repository = os.path.join(self.gitDir, 'sha256.git')
+        try:
+            gitshelve.git('init', '--quiet', '--bare',
+                          '--object-format=sha256', repository)
+        except gitshelve.GitError:
+            self.skipTest("this git can't make SHA-256 repositories")
+        for tag, options in (('a', {}), ('b', {'backend': 'python'}),
+                             ('c', {'commit_engine': 'fast-import'})):
+            s = gitshelve.open('test', repository, defer_writes=True,
+                               **options)
+            self.assertEqual('sha256', s.get_object_format())
+            names = [s.put('blob %s%d' % (tag, i)) for i in range(3)]
+            self.assertEqual(gitshelve.hash_object(
+                'blob', gitshelve.to_bytes('blob %s0' % tag), 'sha256'),
+                names[0])
+            s['key'] = 'value %s' % tag
+            head = s.commit()
+            self.assertEqual(64, len(head))
+            self.assertEqual('blob %s2' % tag,
+                             gitshelve.git('cat-file', 'blob', names[2],
+                                           repository=repository,
+                                           keep_newline=True))
+            s.close()
+
+            for reopen in ({}, {'compact': True}):
+                s = gitshelve.open('test', repository, **reopen)
+                self.assertEqual('blob %s1' % tag, s.get(names[1]))
+                s['key'] = 'value %s' % tag
+                self.assertFalse(s.dirty)
+                s.close()
+
+    def testGitshelvePutMany(self):
+        for tag, options in (('a', {}), ('b', {'backend': 'python'})):
+            s = gitshelve.open('test', **options)
+            values = ['value %s%d' % (tag, i) for i in range(50)]
+            names = s.put_many(value for value in values)
+            self.assertEqual([gitshelve.hash_object('blob',
+                                                    gitshelve.to_bytes(v))
+                              for v in values], names)
+            self.assertEqual('value %s7' % tag, s.get(names[7]))
+            s.commit()
+            summary = s.stats.summary()
+            self.assertFalse('hash-object' in summary)
+            if not options:
+                self.assertEqual(1, summary['fast-import']['count'])
+            s.close()
+
+            s = gitshelve.open('test')
+            self.assertEqual(values, [s.get(name) for name in names])
+            s.close()
+
+        def failing():
+            yield 'kept out'
+            raise RuntimeError('no more')
+        s = gitshelve.open('test')
+        keys = sorted(s.keys())
+        with self.assertRaises(RuntimeError):
+            s.put_many(failing())
+        self.assertEqual(keys, sorted(s.keys()))
+        self.assertFalse(s.dirty)
+        s.close()
+
+    def testGitshelveUnchangedSet(self):
+        s = gitshelve.open('test')
+        s['a/b'] = 'value'
+        s['a/c'] = 'other'
+        head = s.commit()
+        s.close()
+
+        s = gitshelve.open('test')
+        s['a/b'] = 'value'
+        self.assertFalse(s.dirty)
+        self.assertTrue('__root__' in s.objects['a'])
+        self.assertEqual('value', s.get_tree('a/b')['__book__'].data)
+        self.assertFalse('cat-file' in s.stats.summary())
+        self.assertEqual('other', s['a/c'])
+        s['a/c'] = 'other'
+        self.assertFalse(s.dirty)
+        self.assertEqual(head, s.commit())
+
+        s['a/c'] = 'changed'
+        self.assertTrue(s.dirty)
+        self.assertFalse('__root__' in s.objects['a'])
+        self.assertNotEqual(head, s.commit())
+        s.close()
+
+    def testGitshelveRefresh(self):
+        writer = gitshelve.open('test')
+        for path in ('a/x/1', 'a/x/2', 'a/y/1', 'b/1', 'c/d/1', 'top'):
+            writer[path] = path
+        writer.commit()
+
+        for options in ({}, {'lazy': True}, {'compact': True}):
+            reader = gitshelve.open('test', **options)
+            self.assertEqual([], reader.refresh())
+            self.assertEqual('a/x/1', reader['a/x/1'])
+            self.assertEqual('top', reader['top'])
+            book = reader.get_tree('a/x/1')['__book__']
+
+            writer['a/x/2'] = 'changed'
+            writer['a/z/1'] = 'new'
+            writer['b/2'] = 'new'
+            del writer['c/d/1']
+            del writer['top']
+            writer['top/1'] = 'now a tree'
+            writer.commit()
+
+            self.assertEqual(['a/x/2', 'a/z/1', 'b/2', 'c/d/1', 'top',
+                              'top/1'], reader.refresh())
+            self.assertEqual(writer.head, reader.head)
+            self.assertTrue(book is reader.get_tree('a/x/1')['__book__'])
+            self.assertEqual('a/x/1', book.data)
+            self.assertEqual(sorted(writer.keys()), sorted(reader.keys()))
+            for key in writer.keys():
+                self.assertEqual(writer[key], reader[key])
+
+            # the cached tree names must match the new head
+            reader['a/y/1'] = 'from the reader'
+            reader.commit()
+            writer['a/y/1'] = 'from the reader'
+            self.assertEqual(gitshelve.git('rev-parse', 'test^{tree}'),
+                             writer.make_tree(writer.objects))
+            reader.close()
+
+            # and a directory turned back into a file of the same name
+            reader = gitshelve.open('test', **options)
+            self.assertEqual('now a tree', reader['top/1'])
+            writer = gitshelve.open('test')
+            writer['a/x/2'] = 'a/x/2'
+            writer['c/d/1'] = 'c/d/1'
+            del writer['a/z/1']
+            del writer['b/2']
+            del writer['top/1']
+            writer['top'] = 'top'
+            writer.commit()
+
+            self.assertEqual(['a/x/2', 'a/z/1', 'b/2', 'c/d/1', 'top',
+                              'top/1'], sorted(reader.refresh()))
+            self.assertEqual(sorted(writer.keys()), sorted(reader.keys()))
+            self.assertEqual('top', reader['top'])
+            reader.close()
+
+        reader = gitshelve.open('test')
+        reader['b/1'] = 'dirty'
+        with self.assertRaises(ValueError):
+            reader.refresh()
+        reader.close()
+
+    def testGitshelveWatcher(self):
+        writer = gitshelve.open('test')
+        writer['a'] = 'first'
+        writer.commit()
+
+        for use_inotify in (True, False):
+            reader = gitshelve.open('test')
+            watcher = gitshelve.gitwatcher(reader, interval=0.05,
+                                           use_inotify=use_inotify)
+            if not use_inotify:
+                self.assertEqual(None, watcher.inotify)
+            watcher.start()
+            try:
+                spawns = reader.stats.spawns()
+                time.sleep(0.2)
+                self.assertEqual(spawns, reader.stats.spawns())
+
+                writer['a'] = 'second %s' % use_inotify
+                writer.commit()
+                for i in range(100):
+                    if reader.head == writer.head:
+                        break
+                    time.sleep(0.05)
+                self.assertEqual(writer.head, reader.head)
+                self.assertEqual('second %s' % use_inotify, reader['a'])
+            finally:
+                watcher.stop()
+            self.assertEqual(None, watcher.error)
+            reader.close()
+
+        # packed refs count too, and a callback replaces the refresh
+        changes = []
+        reader = gitshelve.open('test')
+        with gitshelve.gitwatcher(reader, changes.append, 0.05):
+            gitshelve.git('pack-refs', '--all')
+            for i in range(100):
+                if changes:
+                    break
+                time.sleep(0.05)
+        self.assertEqual([reader], changes[:1])
+        reader.close()
+
+        # a change that couldn't be applied is tried again
+        def refresh_later(shelf):
+            if not changes:
+                changes.append(shelf)
+                raise ValueError("not now")
+            shelf.refresh()
+
+        changes = []
+        reader = gitshelve.open('test')
+        watcher = gitshelve.gitwatcher(reader, refresh_later,
+                                       use_inotify=False)
+        writer['a'] = 'third'
+        writer.commit()
+        self.assertTrue(watcher.check())
+        self.assertTrue(isinstance(watcher.error, ValueError))
+        self.assertNotEqual(writer.head, reader.head)
+        self.assertTrue(watcher.check())
+        self.assertEqual(None, watcher.error)
+        self.assertEqual(writer.head, reader.head)
+        self.assertEqual('third', reader['a'])
+        self.assertFalse(watcher.check())
+        watcher.stop()
+        reader.close()
+
+    def testGitshelveRetry(self):
+        for options in ({}, {'backend': 'python'}, {'lazy': True},
+                        {'commit_engine': 'fast-import'}):
+            branch = 'retry-%d' % len(gitshelve.git('branch').split('\n'))
+            s = gitshelve.open(branch, **options)
+            for i in range(5):
+                s['d%d/k' % i] = 'value %d' % i
+            base = s.commit()
+            s.close()
+
+            other = gitshelve.open(branch)
+            ours = gitshelve.open(branch, retries=3, retry_backoff=0.001,
+                                  **options)
+            stale = gitshelve.open(branch, **options)
+            other['d0/k'] = 'theirs'
+            other['d0/new'] = 'theirs'
+            del other['d1/k']
+            other['d5/k'] = 'theirs'
+            other['d4/k'] = 'both'
+            theirs = other.commit()
+
+            ours['d2/k'] = 'ours'
+            ours['d0/mine'] = 'ours'
+            del ours['d3/k']
+            ours['d4/k'] = 'both'
+            head = ours.commit()
+            self.assertEqual(theirs, gitshelve.git('rev-parse',
+                                                   '%s^' % branch))
+            self.assertEqual(head, gitshelve.git('rev-parse', branch))
+            self.assertEqual(set(), ours.changed)
+            self.assertFalse(ours.dirty)
+            expected = {'d0/k': 'theirs', 'd0/new': 'theirs',
+                        'd0/mine': 'ours', 'd2/k': 'ours', 'd4/k': 'both',
+                        'd5/k': 'theirs'}
+            self.assertEqual(expected, dict((key, ours[key])
+                                            for key in ours.keys()))
+            fresh = gitshelve.open(branch)
+            self.assertEqual(expected, dict((key, fresh[key])
+                                            for key in fresh.keys()))
+            # the rebuilt trees are the ones a shelf writes from scratch
+            tree = gitshelve.git('rev-parse', '%s^{tree}' % branch)
+            fresh['d2/k'] = 'value 2'
+            fresh.commit()
+            fresh['d2/k'] = 'ours'
+            self.assertEqual(tree, gitshelve.git('rev-parse', '%s^{tree}' %
+                                                 fresh.commit()))
+
+            # without retries the stale shelf still fails outright
+            stale['d2/k'] = 'stale'
+            with self.assertRaises(gitshelve.GitError) as cm:
+                stale.commit()
+            self.assertFalse(isinstance(cm.exception, gitshelve.GitConflict))
+
+            # keys changed on both sides are reported
+            stale.retries = 1
+            with self.assertRaises(gitshelve.GitConflict) as cm:
+                stale.commit()
+            self.assertEqual(['d2/k'], cm.exception.paths)
+            stale['d2/k'] = 'ours'
+            stale['d1/k'] = 'stale'
+            stale['d5/k/deeper'] = 'stale'
+            with self.assertRaises(gitshelve.GitConflict) as cm:
+                stale.commit()
+            self.assertEqual(['d1/k', 'd5/k/deeper'], cm.exception.paths)
+            self.assertEqual(base, stale.head)
+            for shelf in (other, ours, stale, fresh):
+                shelf.dirty = False
+                shelf.close()
+
+            # a directory the branch turned into a file is kept
+            ours = gitshelve.open(branch, retries=3, retry_backoff=0.001,
+                                  **options)
+            other = gitshelve.open(branch)
+            del other['d0/k']
+            del other['d0/new']
+            del other['d0/mine']
+            other['d0'] = 'now a file'
+            other.commit()
+            ours['x'] = 'ours'
+            ours.commit()
+            fresh = gitshelve.open(branch)
+            self.assertEqual('now a file', fresh['d0'])
+            self.assertEqual('ours', fresh['x'])
+            self.assertEqual(sorted(fresh.keys()), sorted(ours.keys()))
+            for shelf in (other, ours, fresh):
+                shelf.close()
+
+            # a shelf opened before its branch existed doesn't overwrite
+            # the first commit made there by someone else
+            for retries in (0, 3):
+                new = '%s-new-%d' % (branch, retries)
+                early = gitshelve.open(new, retries=retries,
+                                       retry_backoff=0.001, **options)
+                other = gitshelve.open(new)
+                other['a'] = 'theirs'
+                theirs = other.commit()
+                early['b'] = 'ours'
+                if not retries:
+                    with self.assertRaises(gitshelve.GitError):
+                        early.commit()
+                    self.assertEqual(theirs, gitshelve.git('rev-parse', new))
+                    early.dirty = False
+                else:
+                    early.commit()
+                    self.assertEqual(theirs, gitshelve.git('rev-parse',
+                                                           '%s^' % new))
+                    self.assertEqual({'a': 'theirs', 'b': 'ours'},
+                                     dict((key, early[key])
+                                          for key in early.keys()))
+                early.close()
+                other.close()
+
+    def testGitshelveCommitLock(self):
+        s = gitshelve.open('test', commit_lock=True, lock_timeout=0.05)
+        s['a'] = 'first'
+        first = s.commit()
+        lock = s.get_branch_lock()
+        self.assertTrue(os.path.isfile(lock.path))
+        self.assertTrue(lock.path.startswith(
+            os.path.join(self.gitDir, '.git')))
+
+        # a commit waits for the lock, and gives up after lock_timeout
+        other = gitshelve.gitlock(lock.path)
+        other.acquire()
+        s['a'] = 'second'
+        start = time.time()
+        with self.assertRaises(gitshelve.GitError):
+            s.commit()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(first, gitshelve.git('rev-parse', 'test'))
+        other.release()
+        second = s.commit()
+        self.assertEqual(second, gitshelve.git('rev-parse', 'test'))
+
+        # a branch moved before the lock was taken is merged, not refused
+        stale = gitshelve.open('test', commit_lock=True)
+        s['b'] = 'theirs'
+        s.commit()
+        stale['c'] = 'ours'
+        head = stale.commit()
+        self.assertEqual(s.head, gitshelve.git('rev-parse', '%s^' % head))
+        self.assertEqual(['a', 'b', 'c'], sorted(gitshelve.open('test')))
+        stale.close()
+        s.close()
+
+        # committers in several threads take turns
+
+        def writer(n):
+            shelf = gitshelve.open('test', commit_lock=True)
+            for i in range(5):
+                shelf['w%d/%d' % (n, i)] = 'value'
+                shelf.commit()
+            shelf.close()
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4 + 15, int(gitshelve.git('rev-list', '--count',
+                                                   'test')))
+        self.assertEqual(3 + 15, len(list(gitshelve.open('test'))))
+
+    def testGitshelveAutocommit(self):
+        # without an autocommit thread, waiting simply commits
+        s = gitshelve.open('test')
+        self.assertEqual(None, s.autocommitter)
+        s['a'] = 'plain'
+        self.assertEqual(1, s.sequence)
+        self.assertTrue(s.wait_for_commit())
+        self.assertEqual(s.head, gitshelve.git('rev-parse', 'test'))
+        s.close()
+
+        # the thread is only started once the branch has been read
+        s = gitshelve.gitshelve('test', autocommit_keys=3)
+        self.assertEqual(None, s.autocommitter)
+        s.close()
+
+        s = gitshelve.open('test', autocommit_keys=3)
+        head = s.head
+        s['a'] = 'one'
+        s['b'] = 'two'
+        self.assertEqual(head, s.head)
+        self.assertEqual(0, s.committed_sequence)
+        s['c'] = 'three'
+        self.assertTrue(s.wait_for_commit(timeout=5))
+        self.assertNotEqual(head, s.head)
+        self.assertEqual(s.head, gitshelve.git('rev-parse', 'test'))
+        self.assertEqual(3, s.committed_sequence)
+        # waiting for a write asks for it to be committed right away
+        s['d'] = 'four'
+        self.assertTrue(s.wait_for_commit(s.sequence, timeout=5))
+        self.assertEqual('four', gitshelve.open('test')['d'])
+        self.assertTrue(s.wait_for_commit(1))
+        s.close()
+        self.assertEqual(None, s.autocommitter)
+
+        s = gitshelve.open('test', autocommit_bytes=100)
+        s['e'] = 'x' * 50
+        head = s.head
+        s.put('y' * 60)
+        self.assertTrue(s.wait_for_commit(timeout=5))
+        self.assertNotEqual(head, s.head)
+        s.close()
+
+        s = gitshelve.open('test', autocommit_interval=0.05)
+        start = time.time()
+        s['a'] = 'timed'
+        self.assertTrue(s.wait_for_commit(timeout=5))
+        self.assertTrue(time.time() - start >= 0.04)
+        s.autocommit_interval = 60
+        s['a'] = 'later'
+        self.assertFalse(s.wait_for_commit(timeout=0.05))
+        # close() commits whatever is left
+        s.close()
+        self.assertEqual('later', gitshelve.open('test')['a'])
+
+        # writers in several threads share the commits
+        s = gitshelve.open('test', autocommit_keys=10)
+        commits = int(gitshelve.git('rev-list', '--count', 'test'))
+
+        def writer(n):
+            for i in range(25):
+                s['w%d/%d' % (n, i)] = 'value %d' % i
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(100, s.sequence)
+        s.close()
+        commits = int(gitshelve.git('rev-list', '--count', 'test')) - commits
+        self.assertTrue(1 <= commits <= 10)
+        shelf = gitshelve.open('test')
+        self.assertEqual('value 24', shelf['w3/24'])
+        self.assertEqual(100, len([key for key in shelf
+                                   if key.startswith('w')]))
+
+    def testGitshelvePythonRefs(self):
+        s = gitshelve.open('test', backend='python')
+        s['a'] = 'first'
+        first = s.commit()
+        self.assertEqual(first, gitshelve.git('rev-parse', 'test'))
+        s['a'] = 'second'
+        second = s.commit()
+        self.assertEqual(second, gitshelve.git('rev-parse', 'test'))
+        self.assertEqual(second, s.current_head())
+        summary = s.stats.summary()
+        self.assertFalse('update-ref' in summary)
+        reflog = gitshelve.git('reflog', 'show', '--format=%H %gs', 'test')
+        self.assertEqual([second, first], [line.split()[0] for line in
+                                           reflog.split('\n')])
+        self.assertEqual(gitshelve.git('var', 'GIT_COMMITTER_IDENT')
+                         .rsplit(' ', 2)[0],
+                         gitshelve.git('log', '-g', '-1', '--format=%gn <%ge>',
+                                       'test'))
+
+        # a stale shelf is refused
+        other = gitshelve.open('test', backend='python')
+        s['a'] = 'third'
+        third = s.commit()
+        other['a'] = 'conflicting'
+        with self.assertRaises(gitshelve.GitError):
+            other.commit()
+        self.assertEqual(third, gitshelve.git('rev-parse', 'test'))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.gitDir, '.git', 'refs', 'heads', 'test.lock')))
+
+        # as is a ref somebody else has locked
+        lock = os.path.join(self.gitDir, '.git', 'refs', 'heads',
+                            'test.lock')
+        with open(lock, 'w') as f:
+            f.write('')
+        s['a'] = 'fourth'
+        with self.assertRaises(gitshelve.GitError):
+            s.commit()
+        os.unlink(lock)
+        fourth = s.commit()
+        s.close()
+
+        # packed and symbolic refs
+        gitshelve.git('pack-refs', '--all')
+        gitshelve.git('symbolic-ref', 'refs/heads/alias', 'refs/heads/test')
+        s = gitshelve.open('alias', backend='python')
+        self.assertEqual(fourth, s.head)
+        self.assertEqual('fourth', s['a'])
+        s['a'] = 'fifth'
+        s.commit()
+        self.assertEqual(s.head, gitshelve.git('rev-parse', 'test'))
+        self.assertEqual('refs/heads/test',
+                         gitshelve.git('symbolic-ref', 'refs/heads/alias'))
+        s.close()
+
+        s = gitshelve.open('new', backend='python')
+        self.assertEqual(None, s.head)
+        s['a'] = 'new'
+        self.assertEqual(s.commit(), gitshelve.git('rev-parse', 'new'))
+        s.close()
+
     def testGitshelveGetParentIds(self):
         # TODO: figure out more meaningful tests for this
         s = gitshelve.gitshelve()
@@ -594,6 +1652,59 @@ Author: .+
 Date:   .+
 """, log))
 
+    def testFastImportCommit(self):
+        shelf = gitshelve.open('test', commit_engine='fast-import')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/other.c'] = text
+        shelf['top.c'] = text
+        hash1 = shelf.commit('first\n')
+        self.assertEqual(hash1, shelf.current_head())
+        self.assertEqual([], shelf.get_parent_ids())
+        self.assertEqual("first\n", gitshelve.git(
+            'log', '-1', '--format=%B', 'test', keep_newline=True)[:-1])
+
+        # the same shelf built with mktree must produce the same trees
+        classic = gitshelve.gitshelve('classic')
+        classic['foo/bar/baz1.c'] = text
+        classic['foo/other.c'] = text
+        classic['top.c'] = text
+        classic.commit('first\n')
+        buf = StringIO()
+        shelf.dump_objects(buf)
+        expected = StringIO()
+        classic.dump_objects(expected)
+        self.assertEqual(expected.getvalue(), buf.getvalue())
+        self.assertEqual(gitshelve.git('rev-parse', 'classic^{tree}'),
+                         gitshelve.git('rev-parse', 'test^{tree}'))
+
+        text = "Hello, this is a change\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/bar/baz2.c'] = text
+        hash2 = shelf.commit()
+        self.assertEqual([hash1], shelf.get_parent_ids())
+        classic['foo/bar/baz1.c'] = text
+        classic['foo/bar/baz2.c'] = text
+        classic.commit()
+        self.assertEqual(gitshelve.git('rev-parse', 'classic^{tree}'),
+                         gitshelve.git('rev-parse', 'test^{tree}'))
+        self.assertEqual('', gitshelve.git('for-each-ref',
+                                           'refs/gitshelve'))
+
+        shelf = gitshelve.open('test', commit_engine='fast-import')
+        self.assertEqual(text, shelf['foo/bar/baz2.c'])
+
+        # the branch moved underneath us, so update_head must refuse
+        gitshelve.git('update-ref', 'refs/heads/test', hash1)
+        shelf['foo/bar/baz3.c'] = text
+        with self.assertRaises(gitshelve.GitError):
+            shelf.commit()
+        self.assertEqual(hash1, gitshelve.git('rev-parse', 'test'))
+        self.assertNotEqual(hash2, hash1)
+
+        with self.assertRaises(ValueError):
+            gitshelve.gitshelve(commit_engine='nothing')
+
     def testDetachedRepo(self):
         repotest = os.path.join(self.gitDir, 'repo-test')
         repotestclone = os.path.join(self.gitDir, 'repo-test-clone')
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gitshelve
+try:
+    import asyncio
+    import gitshelve_async
+except (ImportError, SyntaxError):
+    gitshelve_async = None
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def tick(ticks):
+    """Note every turn the event loop gets, each a hundredth of a second."""
+    while True:
+        ticks.append(None)
+        await asyncio.sleep(0.01)
+
+
+@unittest.skipIf(gitshelve_async is None, "needs Python 3.6 or later")
+class TestGitShelveAsync(unittest.TestCase):
+    def setUp(self):
+        self.gitDir = tempfile.mkdtemp()
+        self.lastCWD = os.getcwd()
+        os.chdir(self.gitDir)
+        gitshelve.git('init', '--quiet')
+        os.environ["GIT_AUTHOR_NAME"] = "John Doe"
+        os.environ["GIT_AUTHOR_EMAIL"] = "doe.j@example"
+        os.environ["GIT_COMMITTER_NAME"] = "John Doe"
+        os.environ["GIT_COMMITTER_EMAIL"] = "doe.j@example"
+
+        s = gitshelve.open('test')
+        for i in range(20):
+            s['d%d/k%d' % (i % 4, i)] = 'value %d' % i
+        s.commit('first')
+        self.tree = gitshelve.git('rev-parse', 'test^{tree}')
+        s.close()
+
+    def tearDown(self):
+        os.chdir(self.lastCWD)
+        shutil.rmtree(self.gitDir)
+
+    def testAsyncGet(self):
+        async def test():
+            s = await gitshelve_async.open('test')
+            self.assertEqual('value 3', await s.get('d3/k3'))
+            paths = ['d%d/k%d' % (i % 4, i) for i in range(20)]
+            values = await s.get_many(paths)
+            self.assertEqual(['value %d' % i for i in range(20)],
+                             [values[path] for path in paths])
+            self.assertTrue(await s.contains('d0/k4'))
+            self.assertFalse(await s.contains('d0/k5'))
+            with self.assertRaises(KeyError):
+                await s.get('d0/k5')
+            # every value came through the one cat-file process
+            self.assertEqual(1, s.shelf.stats.summary()['cat-file']['spawns'])
+            await s.close()
+        run(test())
+
+    def testAsyncCommit(self):
+        async def test():
+            async with await gitshelve_async.open('test') as s:
+                await asyncio.gather(*[s.set('d%d/k%d' % (i % 4, i), 'new')
+                                       for i in range(0, 20, 3)])
+                await s.delete('d1/k1')
+                name = await s.put('stored')
+                head = await s.commit('second')
+                self.assertEqual(head, gitshelve.git('rev-parse', 'test'))
+                self.assertEqual(head, await s.commit())
+
+            s = gitshelve.open('test')
+            self.assertEqual('new', s['d2/k6'])
+            self.assertEqual('value 7', s['d3/k7'])
+            self.assertFalse('d1/k1' in s.keys())
+            self.assertEqual('stored', s.get(name))
+            # the same changes made synchronously give the same tree
+            tree = gitshelve.git('rev-parse', 'test^{tree}')
+            for i in range(0, 20, 3):
+                s['d%d/k%d' % (i % 4, i)] = 'value %d' % i
+            s['d1/k1'] = 'value 1'
+            del s['%s/%s' % (name[:2], name[2:])]
+            s.commit()
+            self.assertEqual(self.tree,
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            s.close()
+            return tree
+
+        tree = run(test())
+        s = gitshelve.open('test')
+        s['d2/k6'] = 'new'
+        self.assertNotEqual(tree, s.commit())
+        s.close()
+
+    def testAsyncCommitLock(self):
+        async def test():
+            s = await gitshelve_async.open('test', commit_lock=True,
+                                           lock_timeout=0.1)
+            other = gitshelve.gitlock(s.shelf.get_branch_lock().path)
+            other.acquire()
+            await s.set('d0/k0', 'locked out')
+            ticks = []
+            ticker = asyncio.ensure_future(tick(ticks))
+            with self.assertRaises(gitshelve.GitError):
+                await s.commit()
+            ticker.cancel()
+            # the loop went on while the commit waited
+            self.assertTrue(len(ticks) > 2)
+            self.assertEqual(s.shelf.head, gitshelve.git('rev-parse', 'test'))
+
+            # the commit goes ahead once the lock is free, onto whatever
+            # was committed before it was
+            writer = gitshelve.open('test')
+            writer['d1/k1'] = 'theirs'
+            writer.commit()
+            other.release()
+            head = await s.commit()
+            self.assertEqual(head, gitshelve.git('rev-parse', 'test'))
+            self.assertEqual('theirs', await s.get('d1/k1'))
+            await s.close()
+            writer.close()
+        run(test())
+
+    def testAsyncRetry(self):
+        async def test():
+            for branch, retries in (('test', 0), ('test', 3),
+                                    ('new0', 0), ('new3', 3)):
+                s = await gitshelve_async.open(branch, retries=retries,
+                                               retry_backoff=0.001)
+                writer = gitshelve.open(branch)
+                writer['d1/k1'] = 'theirs'
+                theirs = writer.commit()
+                writer.close()
+                await s.set('d2/k2', 'ours')
+                if not retries:
+                    with self.assertRaises(gitshelve.GitError):
+                        await s.commit()
+                    self.assertEqual(theirs,
+                                     gitshelve.git('rev-parse', branch))
+                    s.shelf.dirty = False
+                else:
+                    await s.commit()
+                    self.assertEqual(theirs, gitshelve.git(
+                        'rev-parse', '%s^' % branch))
+                    self.assertEqual('theirs', await s.get('d1/k1'))
+                    fresh = gitshelve.open(branch)
+                    self.assertEqual('ours', fresh['d2/k2'])
+                    self.assertEqual('theirs', fresh['d1/k1'])
+                    fresh.close()
+                await s.close()
+        run(test())
+
+    def testAsyncAutocommit(self):
+        async def test():
+            s = await gitshelve_async.open('test', autocommit_keys=2)
+            self.assertTrue(s.shelf.autocommitter.is_alive())
+            name = await s.put('stored')
+            await s.set('d0/k0', 'changed')
+            self.assertTrue(await s.wait_for_commit(timeout=5))
+            self.assertEqual(s.shelf.head, gitshelve.git('rev-parse', 'test'))
+            await s.set('d0/k4', 'changed')
+            self.assertEqual(2, s.shelf.committed_sequence)
+
+            # while the thread holds the shelf's mutex, as it does when it
+            # commits, a change waits for it without holding up the loop
+            holding = threading.Event()
+
+            def hold():
+                s.shelf.mutex.acquire()
+                try:
+                    holding.set()
+                    time.sleep(0.2)
+                finally:
+                    s.shelf.mutex.release()
+            holder = threading.Thread(target=hold)
+            holder.start()
+            holding.wait()
+            ticks = []
+            ticker = asyncio.ensure_future(tick(ticks))
+            await s.set('d0/k8', 'changed')
+            ticker.cancel()
+            holder.join()
+            self.assertTrue(len(ticks) > 5)
+            self.assertTrue(await s.wait_for_commit(timeout=5))
+            self.assertEqual(4, s.shelf.committed_sequence)
+            await s.close()
+            self.assertEqual(None, s.shelf.autocommitter)
+            return name
+
+        name = run(test())
+        s = gitshelve.open('test')
+        self.assertEqual('stored', s.get(name))
+        self.assertEqual('changed', s['d0/k4'])
+        self.assertEqual('changed', s['d0/k8'])
+        s.close()
+
+    def testAsyncIteration(self):
+        async def test():
+            for options in ({}, {'lazy': True}, {'compact': True}):
+                s = await gitshelve_async.open('test', **options)
+                keys = [key async for key in s]
+                self.assertEqual(sorted('d%d/k%d' % (i % 4, i)
+                                        for i in range(20)), sorted(keys))
+                items = dict([item async for item in s.items()])
+                self.assertEqual('value 13', items['d1/k13'])
+                await s.close()
+
+            s = await gitshelve_async.open('test', lazy=True)
+            await s.set('d0/k0', 'lazy')
+            await s.commit()
+            self.assertEqual(['__root__'], list(dict.keys(
+                dict.__getitem__(s.shelf.objects, 'd1'))))
+            await s.close()
+            self.assertEqual('lazy', gitshelve.open('test')['d0/k0'])
+        run(test())
+
+
+if __name__ == '__main__':
+    unittest.main()